@@ -1,9 +1,9 @@
-import serial
 import time
 
+from connections import open_pump
+
 # Adjust port to match your system (e.g. 'COM3' on Windows or '/dev/ttyUSB0' on Linux)
-arduino = serial.Serial('COM6', 9600, timeout=2)
-time.sleep(2)  # Wait for Arduino to initialize
+arduino = open_pump('COM6')  # no reset, so no 2 s wait for the Arduino to boot
 
 def send_command(cmd):
     print(f">> Sending: {cmd}")
@@ -2,10 +2,8 @@
 # -*- coding: utf-8 -*-
 
 import time
-from statistics import mean
 
-from motorcontroller import MotorController
-from scale_reader   import open_scale, read_weight
+import connections
 from eis_module     import main as run_eis  # Uncomment if EIS module is needed
 
 # —— Configurable Parameters —— #
@@ -37,39 +35,15 @@ def steps_to_volume(steps, per_ml):
 
 def wait_for_stable_weight(window=3, threshold=0.001, timeout=6):
     """
-    Ultra-fast weight stabilization checker using non-blocking reads.
-    Uses serial.in_waiting to maximize response speed.
+    Weight stabilization checker on the background scale stream: returns the
+    mean of the first `window` fresh readings within `threshold` g, or 0.0 if
+    nothing arrived within `timeout` s.
     """
-    from statistics import mean
-    import collections
-
-    weights = collections.deque(maxlen=window)
-    start_time = time.time()
-    ser = open_scale(port=PORT_SCALE, timeout=0.05)
-
-    try:
-        while True:
-            if ser.in_waiting:  # If there is data to be read by this port
-                try:
-                    w = read_weight(ser)
-                    weights.append(w)
-                    if len(weights) == window:
-                        delta = max(weights) - min(weights)
-                        if delta < threshold:
-                            return mean(weights)
-                except Exception as e:
-                    print(f"[Warning] read failed: {e}")
-            if time.time() - start_time > timeout:
-                print()
-                return mean(weights) if weights else 0.0
-            time.sleep(0.05)
-    except KeyboardInterrupt:
-        print("\nEnd by user.")
-    finally:
-        ser.close()
+    weight = connections.scale_stream(PORT_SCALE).wait_stable(window, threshold, timeout)
+    return 0.0 if weight is None else weight
 
 def automated_pipeline():
-    motor     = MotorController(port=PORT_MOTOR)
+    motor     = connections.motor(PORT_MOTOR)
 
     for i in range(1, 21):
         print("---------------This is Cycle ", i, " ---------------")
@@ -157,7 +131,6 @@ def automated_pipeline():
         print("---------------All 10 cycles complete!!---------------")
     finally:
         motor.disable_steppers()
-        motor.close()
 
 if __name__ == "__main__":
     automated_pipeline()
@@ -1,48 +1,59 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import threading
 import time
-from statistics import mean
 
-from motorcontroller import MotorController
-from scale_reader   import open_scale, read_weight
+import connections
+from dispense_scheduler import DispenseScheduler, MotorOp
+from gravimetric import dispense_to_mass
+from pump_calibration import PumpCalibration
+from telemetry import TelemetryLog
+import sd_macros
+from settle import SETTLE_TIMEOUT, wait_settled
+from flow import FINISH_TIMEOUT, wait_finished
 from eis_module_updated  import main as run_eis  # Uncomment if EIS module is needed
 
 
-def wait_for_stable_weight(window=3, threshold=0.001, timeout=6):
+# One potentiostat for every station: measurements take turns
+_eis_lock = threading.Lock()
+
+# Per-station state (fitted pump constants, telemetry log) by scale port,
+# loaded once per process
+_stations = {}
+_stations_lock = threading.Lock()
+
+def _station(kind, scale_port, factory):
+    with _stations_lock:
+        if (kind, scale_port) not in _stations:
+            _stations[kind, scale_port] = factory(scale_port)
+        return _stations[kind, scale_port]
+
+def wait_for_stable_weight(timeout=SETTLE_TIMEOUT, port='COM5'):
     """
-    Ultra-fast weight stabilization checker using non-blocking reads.
-    Uses serial.in_waiting to maximize response speed.
+    Settled weight from the station's scale stream. Returns as soon as the
+    mass is statistically flat (see settle.py), so no drip sleep is needed
+    before it; gives up with the latest estimate after `timeout` s.
     """
-    from statistics import mean
-    import collections
-    PORT_SCALE     = 'COM5'
-    weights = collections.deque(maxlen=window)
-    start_time = time.time()
-    ser = open_scale(port=PORT_SCALE, timeout=0.05)
+    settled = wait_settled(connections.scale_stream(port), timeout)
+    print(f"    Settled at {settled.weight:.4f} ± {settled.ci:.4f} g after {settled.elapsed:.1f} s")
+    return settled.weight
 
-    try:
-        while True:
-            if ser.in_waiting:  # If there is data to be read by this port
-                try:
-                    w = read_weight(ser)
-                    weights.append(w)
-                    if len(weights) == window:
-                        delta = max(weights) - min(weights)
-                        if delta < threshold:
-                            return mean(weights)
-                except Exception as e:
-                    print(f"[Warning] read failed: {e}")
-            if time.time() - start_time > timeout:
-                print()
-                return mean(weights) if weights else 0.0
-            time.sleep(0.05)
-    except KeyboardInterrupt:
-        print("\nEnd by user.")
-    finally:
-        ser.close()
+def wait_for_flow_stop(timeout=FINISH_TIMEOUT, port='COM5'):
+    """
+    Weight once liquid stops running onto the station's scale (flow.py): the
+    next step can start as soon as the last drops are in, not after a fixed sleep.
+    """
+    finished = wait_finished(connections.scale_stream(port), timeout)
+    print(f"    Dispense finished at {finished.weight:.4f} g after {finished.elapsed:.1f} s")
+    return finished.weight
 
-def automated_pipeline(CONC_A, CONC_B, CONC_C):
+def automated_pipeline(CONC_A, CONC_B, CONC_C, motor=None, scale_port='COM5'):
+    """
+    Run the full protocol on one station. `motor` is the station's
+    MotorController (default: the shared board on PORT_MOTOR) and `scale_port`
+    its balance, so several stations can run at once through a MotorFleet.
+    """
 
     # —— Configurable Parameters —— #
     MOTOR_A        = 'X'     # Dispense Solution A NACL (-)
@@ -52,6 +63,8 @@ def automated_pipeline(CONC_A, CONC_B, CONC_C):
     MOTOR_EXTRACT  = 'E1'    # Extraction (+)
     MOTOR_WASH_IN  = 'E3'    # Wash-in （-）
 
+    # Nominal constants: they seed the fit in pump_calibration_<scale_port>.jsonl,
+    # whose live estimate is used once it has seen a few dispenses
     STEPS_PER_ML_A = -1345      # Motor steps per mL for A (X)
     STEPS_PER_ML_B = -1350       # Motor steps per mL for B (E0)
     STEPS_PER_ML_C = -1150       # Motor steps per mL for C (E2)
@@ -77,134 +90,150 @@ def automated_pipeline(CONC_A, CONC_B, CONC_C):
     PORT_MOTOR     = 'COM4'
 
     MAX_VOLUME = 30
+    USE_SD_MACROS = False     # Run the wash loop from the SD card (firmware needs SDSUPPORT + BINARY_FILE_TRANSFER)
     # —— End Config —— #
 
-    motor     = MotorController(port=PORT_MOTOR)
-
-    motor.enable_steppers()
-    motor.set_absolute_positioning()
-    motor.set_current_position(0, 0, 0, {f'E{i}': 0 for i in range(5)})
-    motor.move_motor_by_steps(MOTOR_EXTRACT, 500000, 2000)
-    
-    # Step 1: Initial stable weight
-    time.sleep(60)  
-    print(">>> Measuring initial stable weight...")
-    initial_weight = wait_for_stable_weight()
-    MAX_VOLUME = MAX_VOLUME + initial_weight
-    time.sleep(10)
-    print(f"Initial weight: {initial_weight:.4f} g")
-
-    # Step 2: Add Solution A
-    print(">>> Dispensing Solution A")
-    steps_A = int(VOLUME_A * STEPS_PER_ML_A)
-    motor.move_motor_by_steps(MOTOR_A, steps_A, 2000)
-    time.sleep(40)
-    weight_after_A = wait_for_stable_weight()
-    time.sleep(10)
-    if weight_after_A >= MAX_VOLUME:
-        print(">>> Extracting solution...")
-        motor.move_motor_by_steps(MOTOR_EXTRACT, EXTRACT_STEPS, 500)
-        return "Warning! Weight over max range!!"
-    delta_A = weight_after_A - initial_weight
-    print(f"[A] Current weight: {weight_after_A:.4f} g | Estimated volume: {delta_A:.2f} mL")
-
-    # Step 3: Add Solution B
-    print(">>> Dispensing Solution B")
-    steps_B = int(VOLUME_B * STEPS_PER_ML_B)
-    motor.move_motor_by_steps(MOTOR_B, steps_B, 500)
-    time.sleep(40)
-    weight_after_B = wait_for_stable_weight()
-    time.sleep(5)
-    if weight_after_B >= MAX_VOLUME:
-        print(">>> Extracting solution...")
-        motor.move_motor_by_steps(MOTOR_EXTRACT, EXTRACT_STEPS, 2000)
-        return "Warning! Weight over max range!!"
-    delta_B = weight_after_B - weight_after_A
-    print(f"[B] Current weight: {weight_after_B:.4f} g | Incremental volume: {delta_B:.2f} mL")
-
-    # Step 4: Add Solution C
-    print(">>> Dispensing Solution C")
-    steps_C = int(VOLUME_C * STEPS_PER_ML_C)
-    motor.move_motor_by_steps(MOTOR_C, steps_C, 500)
-    time.sleep(40)
-    weight_after_C = wait_for_stable_weight()
-    time.sleep(5)
-    if weight_after_C >= MAX_VOLUME:
-        print(">>> Extracting solution...")
-        motor.move_motor_by_steps(MOTOR_EXTRACT, EXTRACT_STEPS, 2000)
-        return "Warning! Weight over max range!!"
-    delta_C = weight_after_C - weight_after_B
-    print(f"[C] Current weight: {weight_after_C:.4f} g | Incremental volume: {delta_C:.2f} mL")
-    
-    # Step 5: Add Water and calculate the real concentration
-    print(f">>> Adding water")
-    VOLUME_WATER = FINAL_VOLUME - delta_A - delta_B - delta_C
-    steps_water = int(VOLUME_WATER * STEPS_PER_ML_WATER)
-    motor.move_motor_by_steps(MOTOR_WASH_IN, steps_water, 1000)
-    print(f"    Wash-in finished!")
+    if motor is None:
+        motor = connections.motor(PORT_MOTOR)  # opened once, reused by every row
+    scheduler = DispenseScheduler(motor)
+    calibration = _station('calibration', scale_port, PumpCalibration.for_station)
+    # Every scale reading, command and position report of the run goes to the
+    # station's telemetry log, tagged with this run's id
+    telemetry = _station('telemetry', scale_port, TelemetryLog.for_station)
+    telemetry.attach(motor=motor, stream=connections.scale_stream(scale_port))
+    telemetry.start_run(f"{CONC_A}/{CONC_B}/{CONC_C}")
+    try:
+        motor.enable_steppers()
+        motor.set_absolute_positioning()
+        motor.set_current_position(0, 0, 0, {f'E{i}': 0 for i in range(5)})
+        motor.move_motor_by_steps(MOTOR_EXTRACT, 500000, 2000).wait()
     
-    time.sleep(60)
-    total_weight = wait_for_stable_weight()
-    time.sleep(5)
-    if total_weight >= MAX_VOLUME:
-        print(">>> Extracting solution...")
-        motor.move_motor_by_steps(MOTOR_EXTRACT, EXTRACT_STEPS, 2000)
-        return "Warning! Weight over max range!!"
-    delta_Water = total_weight - weight_after_C
-    print(f"[D] Current weight: {total_weight:.4f} g | Incremental volume: {delta_Water:.2f} mL")
-    vol_A = weight_after_A - initial_weight
-    vol_B = weight_after_B - weight_after_A
-    vol_C = weight_after_C - weight_after_B
-    total_volume = total_weight - initial_weight
-    final_conc_A = (vol_A * CONC_A_INIT) / total_volume
-    final_conc_B = (vol_B * CONC_B_INIT) / total_volume
-    final_conc_C = (vol_C * CONC_C_INIT) / total_volume
-    print(f"Total volume: {total_volume:.2f} mL | Final concentration of A: {final_conc_A:.4f} mM | Final concentration of B: {final_conc_B:.4f} mM | Final concentration of C: {final_conc_C:.4f} mM")
-
-    # Step 6: Mixing
-    motor.move_motor_by_steps(MOTOR_MIX, BUBBLE_STEPS, 2000)
-    print(">>> Mixing...")
-    time.sleep(40)
-
-    # Step 7: EIS test (optional) 
-    Z1 = run_eis(final_conc_A, final_conc_B, final_conc_C)
-    print(">>> Running first EIS")
+        # Step 1: Initial stable weight (waits for the extraction to stop dripping)
+        print(">>> Measuring initial stable weight...")
+        initial_weight = wait_for_stable_weight(port=scale_port)
+        MAX_VOLUME = MAX_VOLUME + initial_weight
+        print(f"Initial weight: {initial_weight:.4f} g")
+
+        # Step 2: Add Solution A
+        print(">>> Dispensing Solution A")
+        # Closed loop on the balance: no drip sleeps, and the mass lands on target
+        result_A = dispense_to_mass(motor, MOTOR_A, VOLUME_A, STEPS_PER_ML_A, scale_port, feedrate=2000, calibration=calibration)
+        if result_A.fault:
+            return f"Warning! {result_A.pump}: {result_A.fault}"
+        weight_after_A = result_A.final_weight
+        if weight_after_A >= MAX_VOLUME:
+            print(">>> Extracting solution...")
+            motor.move_motor_by_steps(MOTOR_EXTRACT, EXTRACT_STEPS, 500)
+            return "Warning! Weight over max range!!"
+        delta_A = weight_after_A - initial_weight
+        print(f"[A] Current weight: {weight_after_A:.4f} g | Estimated volume: {delta_A:.2f} mL")
+
+        # Step 3: Add Solution B
+        print(">>> Dispensing Solution B")
+        result_B = dispense_to_mass(motor, MOTOR_B, VOLUME_B, STEPS_PER_ML_B, scale_port, feedrate=500, calibration=calibration)
+        if result_B.fault:
+            return f"Warning! {result_B.pump}: {result_B.fault}"
+        weight_after_B = result_B.final_weight
+        if weight_after_B >= MAX_VOLUME:
+            print(">>> Extracting solution...")
+            motor.move_motor_by_steps(MOTOR_EXTRACT, EXTRACT_STEPS, 2000)
+            return "Warning! Weight over max range!!"
+        delta_B = weight_after_B - weight_after_A
+        print(f"[B] Current weight: {weight_after_B:.4f} g | Incremental volume: {delta_B:.2f} mL")
+
+        # Step 4: Add Solution C
+        print(">>> Dispensing Solution C")
+        result_C = dispense_to_mass(motor, MOTOR_C, VOLUME_C, STEPS_PER_ML_C, scale_port, feedrate=500, calibration=calibration)
+        if result_C.fault:
+            return f"Warning! {result_C.pump}: {result_C.fault}"
+        weight_after_C = result_C.final_weight
+        if weight_after_C >= MAX_VOLUME:
+            print(">>> Extracting solution...")
+            motor.move_motor_by_steps(MOTOR_EXTRACT, EXTRACT_STEPS, 2000)
+            return "Warning! Weight over max range!!"
+        delta_C = weight_after_C - weight_after_B
+        print(f"[C] Current weight: {weight_after_C:.4f} g | Incremental volume: {delta_C:.2f} mL")
     
-    # Step 8: Extract solution
-    motor.move_motor_by_steps(MOTOR_EXTRACT, EXTRACT_STEPS, 2000)
-    print(">>> Extracting solution...")
-    time.sleep(20)
-    post_extract_weight = wait_for_stable_weight()
-    loss = total_weight - post_extract_weight
-    print(f"Extracted volume: {loss:.2f} mL | Weight after extraction: {post_extract_weight:.4f} g")
-
-    # Step 9: Wash cycles
-    for i in range(WASH_CYCLES):
-        
-        steps_in = int((VOLUME_WATER + 2) * STEPS_PER_ML_WATER)
-        motor.move_motor_by_steps(MOTOR_WASH_IN, steps_in, 1000)
-        print(f"    Wash-out finished!")
-        print(f">>> Wash cycle {i+1} - Injecting {WASH_VOLUME_ML+5} mL")
-        time.sleep(1)
-        
-        motor.move_motor_by_steps(MOTOR_EXTRACT, EXTRACT_STEPS, 2000)
+        # Step 5: Add Water and calculate the real concentration
+        print(f">>> Adding water")
+        VOLUME_WATER = FINAL_VOLUME - delta_A - delta_B - delta_C
+        result_water = dispense_to_mass(motor, MOTOR_WASH_IN, VOLUME_WATER, STEPS_PER_ML_WATER, scale_port,
+                                        feedrate=1000, calibration=calibration)
+        if result_water.fault:
+            return f"Warning! {result_water.pump}: {result_water.fault}"
+        # Open-loop water moves below (wash, refill) use the fitted constant
+        steps_per_ml_water = calibration.steps_per_g(MOTOR_WASH_IN, 1000, STEPS_PER_ML_WATER)
+        steps_water = int(VOLUME_WATER * steps_per_ml_water)
         print(f"    Wash-in finished!")
-        print(f">>> Wash cycle {i+1} - Extracting")
-        time.sleep(1)
-        
-
-    # Step 10: Second EIS test (optional)
-    time.sleep(5)
-    motor.move_motor_by_steps(MOTOR_WASH_IN, steps_water, 1000)
-    print(f"    Wash-out finished! Now adding water for 2nd EIS")
-    time.sleep(30)
-    Z2 = run_eis(0, 0, 0)
-    print(">>> Second EIS finished")
-    time.sleep(10)
-
-    motor.disable_steppers()
-    motor.close()
-    return ">>> Protocol complete."
+        total_weight = result_water.final_weight
+        if total_weight >= MAX_VOLUME:
+            print(">>> Extracting solution...")
+            motor.move_motor_by_steps(MOTOR_EXTRACT, EXTRACT_STEPS, 2000)
+            return "Warning! Weight over max range!!"
+        delta_Water = total_weight - weight_after_C
+        print(f"[D] Current weight: {total_weight:.4f} g | Incremental volume: {delta_Water:.2f} mL")
+        vol_A = weight_after_A - initial_weight
+        vol_B = weight_after_B - weight_after_A
+        vol_C = weight_after_C - weight_after_B
+        total_volume = total_weight - initial_weight
+        final_conc_A = (vol_A * CONC_A_INIT) / total_volume
+        final_conc_B = (vol_B * CONC_B_INIT) / total_volume
+        final_conc_C = (vol_C * CONC_C_INIT) / total_volume
+        print(f"Total volume: {total_volume:.2f} mL | Final concentration of A: {final_conc_A:.4f} mM | Final concentration of B: {final_conc_B:.4f} mM | Final concentration of C: {final_conc_C:.4f} mM")
+
+        # Step 6: Mixing
+        mixing = motor.move_motor_by_steps(MOTOR_MIX, BUBBLE_STEPS, 2000)
+        print(f">>> Mixing... (~{mixing.remaining():.0f} s)")
+        mixing.wait()
+
+        # Step 7: EIS test (optional) 
+        with _eis_lock:
+            Z1 = run_eis(final_conc_A, final_conc_B, final_conc_C)
+        print(">>> Running first EIS")
+    
+        # Step 8: Extract solution
+        extraction = motor.move_motor_by_steps(MOTOR_EXTRACT, EXTRACT_STEPS, 2000)
+        print(f">>> Extracting solution... (~{extraction.remaining():.0f} s)")
+        extraction.wait()
+        post_extract_weight = wait_for_stable_weight(port=scale_port)
+        loss = total_weight - post_extract_weight
+        print(f"Extracted volume: {loss:.2f} mL | Weight after extraction: {post_extract_weight:.4f} g")
+
+        # Step 9: Wash cycles (each injection after the previous extraction)
+        wash = []
+        for i in range(WASH_CYCLES):
+            steps_in = int((VOLUME_WATER + 2) * steps_per_ml_water)
+            print(f">>> Wash cycle {i+1} - Injecting {WASH_VOLUME_ML+5} mL, then extracting")
+            wash.append(MotorOp(MOTOR_WASH_IN, steps_in, 1000, name=f"in{i}", after=[f"out{i-1}"] if i else []))
+            wash.append(MotorOp(MOTOR_EXTRACT, EXTRACT_STEPS, 2000, name=f"out{i}", after=[f"in{i}"]))
+        if USE_SD_MACROS:
+            # One upload per distinct wash volume, then no host round trips at all
+            lines = ["G91"]
+            for op in wash:
+                lines += motor.steps_to_gcode(op.motor, op.steps, op.feedrate)
+            sd_macros.run_macro(motor, lines, wait=True)
+        else:
+            # The flow check below is only meaningful once every wash move is over
+            done = scheduler.run(wash)
+            if done is not None:
+                done.wait()
+
+        # Step 10: Second EIS test (optional)
+        wait_for_flow_stop(port=scale_port)
+        motor.move_motor_by_steps(MOTOR_WASH_IN, steps_water, 1000).wait()
+        print(f"    Wash-out finished! Now adding water for 2nd EIS")
+        wait_for_stable_weight(port=scale_port)
+        with _eis_lock:
+            Z2 = run_eis(0, 0, 0)
+        print(">>> Second EIS finished")
+        time.sleep(10)
+
+        print(f"Scheduler: {scheduler.report()}")
+        return ">>> Protocol complete."
+    finally:
+        # Also on the early returns (over max weight, pump fault) and on errors
+        motor.disable_steppers()
+        telemetry.end_run()
 
 if __name__ == "__main__":
     print(automated_pipeline(20, 4, 20.5))
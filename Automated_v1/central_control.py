@@ -1,7 +1,7 @@
 import os
 import pandas as pd
 from automated_eis_pipeline_updated import automated_pipeline
-from motorcontroller import MotorController
+import connections
 import serial
 import time
 
@@ -59,5 +59,5 @@ for file in excel_files:
             print(f"Row {index + 1} has less than 3 columns. Skipped.")
         i = i + 1
 
-arduino.close()
+connections.close_all()
 print("\n✅ Finished all cycles!")
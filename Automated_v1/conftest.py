@@ -0,0 +1,5 @@
+# The virtual board and balance live one level up; this folder's modules come first
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
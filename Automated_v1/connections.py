@@ -0,0 +1,172 @@
+# connections.py
+"""
+Process-wide registry of the serial devices (motor board, scale, pump Arduino).
+
+Each device is opened once, the first time it is asked for, and then reused by
+every pipeline step, Excel row and thread instead of being reopened (and
+waited for) each time. A device that fails its health check is closed and
+reopened on the next request.
+
+    motor = connections.motor('COM4')          # MotorController, thread-safe itself
+    with connections.scale('COM5') as ser:     # serial port, locked while in use
+        w = read_weight(ser)
+    w = connections.scale_stream('COM5').wait_stable()  # background reader of that port
+"""
+import atexit
+import os
+import threading
+import time
+
+import serial
+
+from motorcontroller import MotorController
+from scale_reader import open_scale
+from scale_stream import ScaleStream
+
+PORT_MOTOR = 'COM4'
+PORT_SCALE = 'COM5'
+PORT_PUMP  = 'COM6'
+
+# Time an Arduino needs after a reset before its sketch reads the port
+ARDUINO_BOOT_SECONDS = 2.0
+
+
+class SharedConnection:
+    """One device, opened lazily and shared by the whole process.
+
+    `with conn as device:` holds the connection lock while the device is used,
+    so two threads never interleave reads or writes on the same port.
+    """
+
+    def __init__(self, name, opener, check=None, closer=None):
+        self.name = name
+        self._opener = opener
+        self._check = check or (lambda device: True)
+        self._closer = closer or (lambda device: device.close())
+        self._device = None
+        self.lock = threading.RLock()
+        self.opens = 0  # how many times the device had to be opened
+
+    def get(self):
+        """Return the open device, (re)opening it if it is closed or unhealthy."""
+        with self.lock:
+            if self._device is not None:
+                try:
+                    healthy = self._check(self._device)
+                except Exception:
+                    healthy = False
+                if not healthy:
+                    print(f"[WARN] {self.name} failed its health check, reopening...")
+                    self.reset()
+            if self._device is None:
+                self._device = self._opener()
+                self.opens += 1
+            return self._device
+
+    def reset(self):
+        """Close the device so the next get() opens it again (e.g. after an I/O error)."""
+        with self.lock:
+            if self._device is not None:
+                try:
+                    self._closer(self._device)
+                except Exception:
+                    pass
+                self._device = None
+
+    close = reset
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            return self.get()
+        except Exception:
+            self.lock.release()
+            raise
+
+    def __exit__(self, exc_type, exc, tb):
+        if isinstance(exc, serial.SerialException):
+            # Port went away mid-use: reopen next time
+            self.reset()
+        self.lock.release()
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def register(name, opener, check=None, closer=None):
+    """Return the shared connection `name`, creating it with `opener` on first use."""
+    with _registry_lock:
+        conn = _registry.get(name)
+        if conn is None:
+            conn = SharedConnection(name, opener, check, closer)
+            _registry[name] = conn
+        return conn
+
+
+def close_all():
+    """Close every open device (also runs at interpreter exit)."""
+    with _registry_lock:
+        conns = list(_registry.values())
+    for conn in conns:
+        conn.close()
+
+
+atexit.register(close_all)
+
+
+def _serial_alive(ser):
+    return ser.is_open
+
+
+def _motor_alive(controller):
+    return controller.ser.is_open and controller._reader.is_alive()
+
+
+def _open_motor(port, **kwargs):
+    controller = MotorController(port=port, **kwargs)
+    # Position pushed by the board instead of polled with M114 (if the firmware has it)
+    controller.enable_auto_report()
+    return controller
+
+
+def motor(port=PORT_MOTOR, **kwargs):
+    """Shared MotorController on `port`. MotorController serialises its own
+    commands, so it is returned directly instead of through a lock."""
+    return register(f"motor:{port}", lambda: _open_motor(port, **kwargs), _motor_alive).get()
+
+
+def scale(port=PORT_SCALE, timeout=0.05):
+    """Shared connection to the balance; use it as `with scale() as ser:`."""
+    return register(f"scale:{port}", lambda: open_scale(port=port, timeout=timeout), _serial_alive)
+
+
+def scale_stream(port=PORT_SCALE):
+    """Shared background reader of the balance on `port` (a ScaleStream over
+    the scale() connection), started on first use."""
+    return register(f"scale_stream:{port}", lambda: ScaleStream(scale(port)),
+                    lambda stream: stream.alive(), ScaleStream.close).get()
+
+
+def open_pump(port=PORT_PUMP, baudrate=9600):
+    """Open the pump Arduino without resetting it.
+
+    An Arduino resets when DTR goes high, which normally happens on open and
+    costs ~2 s of bootloader. On Windows the port is opened with DTR held low,
+    so the running sketch takes commands at once; POSIX drivers raise DTR on
+    open regardless, so there the boot time is still waited out.
+    """
+    ser = serial.Serial()
+    ser.port = port
+    ser.baudrate = baudrate
+    ser.timeout = 2
+    ser.dtr = False
+    ser.open()
+    if os.name != 'nt':
+        time.sleep(ARDUINO_BOOT_SECONDS)
+    return ser
+
+
+def pump(port=PORT_PUMP):
+    """Shared connection to the pump Arduino; use it as `with pump() as ser:`."""
+    return register(f"pump:{port}", lambda: open_pump(port), _serial_alive)
@@ -0,0 +1,153 @@
+# flow.py
+"""
+Mass flow rate from the scale stream, and what it tells about a dispense.
+
+flow_rate() resamples the readings onto an even time grid (they do not
+arrive evenly) and takes a Savitzky-Golay derivative over a sliding window,
+all windows in one correlation, giving the flow in g/s; current_flow() is the
+live estimate at the newest reading. On top of that:
+
+* wait_finished() returns once the flow has stayed zero for HOLD_SECONDS:
+  the pump has stopped and the last drops are in, so the next step can start
+  without a fixed drip wait;
+* FlowMonitor compares the flow while a pump runs with what its feedrate and
+  steps-per-gram should give, and flags a pump that delivers far less
+  (clogged tubing, an air lock) while the move is still going.
+
+    finished = wait_finished(connections.scale_stream('COM5'))
+    print(f"dispense finished at {finished.weight:.4f} g")
+"""
+import math
+import time
+
+import numpy as np
+
+FLOW_WINDOW       = 0.5    # s of readings behind one flow estimate...
+MIN_POINTS        = 7      # ...and never fewer readings than this
+FLOW_ORDER        = 2      # polynomial order of the Savitzky-Golay fit
+LIVE_ORDER        = 1      # ...for the live estimate at the newest reading (see current_flow)
+FLOW_ZERO         = 0.003  # g/s still counted as no flow
+HOLD_SECONDS      = 0.5    # zero flow this long means 'finished' (a slow drip shows within it)
+LOW_CHECKS        = 3      # low-flow estimates in a row before a pump is flagged
+FINISH_TIMEOUT    = 60.0
+LOW_FLOW_FRACTION = 0.5    # of the expected flow, below which a pump is flagged
+FLOW_GRACE        = 1.0    # s after the pump starts before its flow is judged (dead volume, scale lag)
+
+
+def savgol_coefficients(points, order=FLOW_ORDER, deriv=1, at=None):
+    """Weights that give the `deriv`-th derivative, per sample, of the least
+    squares polynomial of `order` through `points` samples, at sample `at`
+    (default: the middle one)."""
+    x = np.arange(points) - (points - 1) / 2.0
+    fit = np.linalg.pinv(np.vander(x, order + 1, increasing=True))
+    x0 = 0.0 if at is None else x[at]
+    return sum(math.factorial(k) / math.factorial(k - deriv) * x0 ** (k - deriv) * fit[k]
+               for k in range(deriv, order + 1))
+
+
+def flow_rate(times, weights, window=FLOW_WINDOW, order=FLOW_ORDER, end=False):
+    """(times, flow in g/s) of the readings. Each estimate belongs to the
+    middle of its window, or with end=True to the newest reading in it.
+    Empty arrays if there are too few readings."""
+    empty = np.empty(0), np.empty(0)
+    if len(times) < MIN_POINTS:
+        return empty
+    dt = float(np.median(np.diff(times)))
+    if dt <= 0:
+        return empty
+    grid = np.arange(times[0], times[-1] + dt / 2, dt)
+    points = max(MIN_POINTS, int(round(window / dt))) | 1  # odd, so there is a middle
+    if len(grid) < points:
+        return empty
+    coefficients = savgol_coefficients(points, order, at=-1 if end else None)
+    flow = np.correlate(np.interp(grid, times, weights), coefficients, 'valid') / dt
+    return (grid[points - 1:] if end else grid[points // 2:len(grid) - points // 2]), flow
+
+
+def current_flow(stream, window=FLOW_WINDOW):
+    """Flow (g/s) at the newest reading of a ScaleStream, or None without
+    enough readings. A quadratic's slope at the end of its window is about
+    four times noisier than in the middle, a straight line's is not: this is
+    the mean flow over the last `window` s, with no half-window delay.
+    A slow balance stretches the window to MIN_POINTS of its readings."""
+    rate = stream.rate()
+    span = max(2 * window, (MIN_POINTS + 1) / rate) if rate > 0 else 2 * window
+    times, weights = stream.window(span)
+    flow = flow_rate(times, weights, window, LIVE_ORDER, end=True)[1]
+    return float(flow[-1]) if len(flow) else None
+
+
+class Finished:
+    """Outcome of wait_finished()."""
+
+    def __init__(self, weight, flow, elapsed, finished):
+        self.weight = weight      # g, mean over the last flow window
+        self.flow = flow          # g/s, last estimate
+        self.elapsed = elapsed    # s waited
+        self.finished = finished  # False if the timeout ran out first
+
+    def __repr__(self):
+        state = "finished" if self.finished else "NOT finished"
+        return f"Finished({self.weight:.4f} g, {self.flow * 1000:+.1f} mg/s, {state} in {self.elapsed:.1f} s)"
+
+
+def wait_finished(stream, timeout=FINISH_TIMEOUT, window=FLOW_WINDOW, quiet=False):
+    """
+    Wait on a ScaleStream until the flow has been zero (|flow| < FLOW_ZERO) at
+    every new reading for HOLD_SECONDS. Returns a Finished with the mean mass
+    of the last window; after `timeout` s, the latest values with finished=False.
+    """
+    start = last = time.monotonic()
+    calm_since, flow = None, float('nan')
+    while time.monotonic() - start < timeout:
+        reading = stream.wait_reading(after=last, timeout=start + timeout - time.monotonic())
+        if reading is None:
+            break
+        last = reading[0]
+        estimate = current_flow(stream, window)
+        if estimate is None:
+            continue
+        flow = estimate
+        if abs(flow) >= FLOW_ZERO:
+            calm_since = None
+        elif calm_since is None:
+            calm_since = last
+        if calm_since is not None and last - calm_since >= HOLD_SECONDS:
+            recent = stream.since(last - window)[1]
+            return Finished(float(recent.mean()), flow, time.monotonic() - start, True)
+    newest = stream.latest()
+    if newest is None:
+        raise RuntimeError("No reading from the scale")
+    if not quiet:
+        print(f"[WARN] flow still {flow * 1000:+.1f} mg/s after {timeout:g} s, using {newest[1]:.4f} g")
+    return Finished(newest[1], flow, time.monotonic() - start, False)
+
+
+class FlowMonitor:
+    """Watches one running pump: check() returns a fault message once the
+    flow has stayed under LOW_FLOW_FRACTION of `expected` g/s for
+    LOW_CHECKS checks in a row, FLOW_GRACE s or more after `started`."""
+
+    def __init__(self, stream, expected, started=None):
+        self.stream = stream
+        self.expected = abs(expected)
+        self.started = time.monotonic() if started is None else started
+        self.peak = 0.0
+        self.fault = None
+        self._low = 0
+
+    def check(self):
+        if self.fault is not None or time.monotonic() - self.started < FLOW_GRACE:
+            return self.fault
+        flow = current_flow(self.stream)
+        if flow is None:
+            return None
+        self.peak = max(self.peak, flow)
+        if flow < LOW_FLOW_FRACTION * self.expected:
+            self._low += 1
+        else:
+            self._low = 0
+        if self._low >= LOW_CHECKS:
+            kind = "no flow" if flow < FLOW_ZERO else "low flow"
+            self.fault = f"{kind}, {flow:.3f} g/s of {self.expected:.3f} expected: clogged or air-locked?"
+        return self.fault
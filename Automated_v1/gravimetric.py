@@ -0,0 +1,193 @@
+# gravimetric.py
+"""
+Closed-loop dispensing by mass.
+
+Instead of converting a volume to steps once and hoping the pump constant is
+right, dispense_to_mass() watches the balance while it pumps:
+
+1. coarse: fast moves up to COARSE_FRACTION of the target. While the pump
+   constant is only nominal, a first move stops at PROBE_FRACTION and the
+   second is sized from the rate it measured: a short fast move is over
+   before the balance shows much of it, so only a margin that large keeps a
+   wrong constant (up to +1/PROBE_FRACTION - 1) from overshooting. The scale
+   stream is watched during each move and the pump is stopped at once (M410)
+   if the mass, projected `scale_lag` ahead at the current flow rate, gets
+   there early. The flow is a Savitzky-Golay derivative of the readings
+   (flow.py) and is checked against what the feedrate should give: a pump
+   delivering less than LOW_FLOW_FRACTION of it (clogged, air-locked) is
+   stopped and the dispense ends with result.fault set instead of pulsing on.
+2. fine: short pulses sized from the remaining mass and the pump rate
+   measured in the coarse phase, each followed by a settle, until the mass is
+   within tolerance of the target.
+
+A settle waits until the flow has dropped to zero (flow.wait_finished), so the
+next step starts as soon as the last drops are in.
+
+With a PumpCalibration, both phases are logged to it, the coarse move is
+sized from the fitted pump rate instead of the nominal constant, and once
+that fit is trusted a single coarse move goes to CALIBRATED_FRACTION, so
+most dispenses need one short pulse or none.
+
+Masses are in grams; the pipeline treats 1 g as 1 mL.
+
+    result = dispense_to_mass(motor, 'X', 1.6, steps_per_g=-1345, scale_port='COM5',
+                              calibration=PumpCalibration.for_station('COM5'))
+    print(result.dispensed, result.error)
+"""
+import time
+
+import connections
+from flow import FlowMonitor, LOW_FLOW_FRACTION, current_flow, wait_finished
+
+COARSE_FRACTION  = 0.9    # of the target, dispensed in the coarse phase
+PROBE_FRACTION   = 0.6    # ...of which the first move goes this far while the constant is nominal
+CALIBRATED_FRACTION = 0.97  # ...when the calibration trusts its pump rate
+TOLERANCE_G      = 0.02   # accepted |dispensed - target|
+FINE_GAIN        = 0.8    # share of the remaining mass asked for per pulse (approach from below)
+FINE_FEEDRATE    = 500
+MAX_PULSES       = 15
+SETTLE_TIMEOUT   = 8.0    # s, then the latest reading is taken
+SCALE_LAG        = 0.5    # s the balance reading trails the real mass while it flows
+MIN_RECORD_G     = 0.1    # smaller phases are mostly scale noise: not logged for calibration or judged for faults
+
+
+class DispenseResult:
+    """Outcome of one dispense_to_mass() call."""
+
+    def __init__(self, pump, target, start_weight):
+        self.pump = pump
+        self.target = target
+        self.start_weight = start_weight
+        self.final_weight = start_weight
+        self.steps = 0
+        self.pulses = 0
+        self.stopped_early = False  # coarse move cut short because the target was reached
+        self.steps_per_g = None     # pump rate measured in the coarse phase
+        self.fault = None           # set when the pump delivered far less than it should
+        self.elapsed = 0.0
+
+    @property
+    def dispensed(self):
+        return self.final_weight - self.start_weight
+
+    @property
+    def error(self):
+        return self.dispensed - self.target
+
+    def __repr__(self):
+        fault = f", FAULT: {self.fault}" if self.fault else ""
+        return (f"DispenseResult({self.pump}: {self.dispensed:.4f} g of {self.target:.4f} g, "
+                f"{self.steps} steps, {self.pulses} pulses, {self.elapsed:.1f} s{fault})")
+
+
+def _settled(stream):
+    return wait_finished(stream, SETTLE_TIMEOUT).weight
+
+
+def _coarse(motor, stream, result, steps, feedrate, fraction, steps_per_g, scale_lag):
+    """One move of `steps`, stopped early if the mass reaches `fraction` of
+    the target or the flow stays far below what `feedrate` should give.
+    Returns the steps actually moved."""
+    axis = result.pump[0]
+    before = motor.planned_position(axis)
+    goal = result.start_weight + result.target * fraction
+    expected = feedrate / 60 * motor.steps_per_mm[result.pump] / abs(steps_per_g)
+    last = time.monotonic()
+    move = motor.move_motor_by_steps(result.pump, steps, feedrate)
+    monitor = FlowMonitor(stream, expected)
+    # Watched until the board confirms the move is over, not just until its
+    # predicted end: a pump slower than the motion model is still guarded
+    while not move.done():
+        reading = stream.wait_reading(after=last, timeout=0.1)
+        if reading is None:
+            continue
+        last, weight = reading
+        flow = current_flow(stream) or 0.0
+        if weight + max(flow, 0.0) * scale_lag >= goal:
+            result.stopped_early = True
+            print(f"    [{result.pump}] coarse target reached early, pump stopped")
+        elif monitor.check():
+            result.fault = monitor.fault
+            print(f"[WARN] {result.pump}: {result.fault} Pump stopped")
+        else:
+            continue
+        motor.emergency("M410")
+        # The stop reads the position back: that is how far the pump got
+        moved = motor.planned_position(axis) - before
+        return int(round(moved * motor.steps_per_mm[result.pump]))
+    return steps
+
+
+def dispense_to_mass(motor, pump, target, steps_per_g, scale_port='COM5', feedrate=2000,
+                     tolerance=TOLERANCE_G, calibration=None, scale_lag=SCALE_LAG):
+    """
+    Dispense `target` grams with `pump` ('X', 'E0', ...). `steps_per_g` is the
+    nominal pump constant (sign gives the direction); it only sizes the
+    first coarse move, the rest use the rate actually measured. With a
+    `calibration` (PumpCalibration) its live estimate replaces the nominal
+    constant and the dispense is recorded in it. `scale_lag` is the balance's
+    response time (s) while the mass rises.
+    Returns a DispenseResult; the final weight is a settled reading.
+    """
+    started = time.monotonic()
+    nominal, fractions = steps_per_g, (PROBE_FRACTION, COARSE_FRACTION)
+    if calibration is not None:
+        steps_per_g = calibration.steps_per_g(pump, feedrate, nominal)
+        if calibration.trusted(pump, feedrate):
+            fractions = (CALIBRATED_FRACTION,)
+    stream = connections.scale_stream(scale_port)
+    result = DispenseResult(pump, target, _settled(stream))
+    if target <= tolerance:
+        return result
+
+    rate = steps_per_g
+    for fraction in fractions:
+        steps = int(round((target * fraction - result.dispensed) * rate))
+        if steps * steps_per_g <= 0:
+            break
+        moved = _coarse(motor, stream, result, steps, feedrate, fraction, rate, scale_lag)
+        result.steps += moved
+        result.final_weight = _settled(stream)
+        expected = result.steps / steps_per_g
+        # Moves too short for the flow to be judged while they run end up here;
+        # below MIN_RECORD_G the balance's noise could pass for a clog
+        judged = expected >= MIN_RECORD_G
+        if result.fault is None and judged and result.dispensed < LOW_FLOW_FRACTION * expected:
+            result.fault = f"{result.dispensed:.4f} g of {expected:.4f} g expected: clogged or air-locked?"
+            print(f"[WARN] {pump}: {result.fault}")
+        if result.fault is not None:
+            # Neither worth pulsing on nor worth fitting the pump constants to
+            result.elapsed = time.monotonic() - started
+            return result
+        if result.dispensed > tolerance and result.steps * steps_per_g > 0:
+            rate = result.steps / result.dispensed
+            result.steps_per_g = rate
+        print(f"    [{result.pump}] coarse: {result.dispensed:.4f} / {target:.4f} g")
+    coarse_steps, coarse_grams = result.steps, result.dispensed
+    if calibration is not None:
+        if coarse_grams > MIN_RECORD_G:
+            calibration.record(pump, coarse_steps, feedrate, coarse_grams, nominal)
+        # Pulses run at FINE_FEEDRATE, where the fit may know the rate better
+        if calibration.trusted(pump, FINE_FEEDRATE):
+            rate = calibration.steps_per_g(pump, FINE_FEEDRATE, rate)
+
+    while result.pulses < MAX_PULSES:
+        remaining = target - result.dispensed
+        if remaining <= tolerance:
+            break
+        steps = int(round(remaining * FINE_GAIN * rate)) or (1 if rate > 0 else -1)
+        motor.move_motor_by_steps(pump, steps, FINE_FEEDRATE).wait()
+        result.steps += steps
+        result.pulses += 1
+        result.final_weight = _settled(stream)
+        print(f"    [{result.pump}] pulse {result.pulses}: {result.dispensed:.4f} / {target:.4f} g")
+    if target - result.dispensed > tolerance:
+        print(f"[WARN] {pump}: {result.dispensed:.4f} g after {MAX_PULSES} pulses (target {target:.4f} g)")
+    fine_grams = result.dispensed - coarse_grams
+    if calibration is not None and fine_grams > MIN_RECORD_G:
+        calibration.record(pump, result.steps - coarse_steps, FINE_FEEDRATE, fine_grams, nominal)
+
+    result.elapsed = time.monotonic() - started
+    if result.error > tolerance:
+        print(f"[WARN] {pump}: overshoot by {result.error:.4f} g")
+    return result
@@ -0,0 +1,121 @@
+"""Incremental serial line framing without per-line copies.
+
+pyserial's readline() reads one byte per call and returns a new bytes
+object for every line, which then gets decoded, stripped and split. The
+framer instead reads whatever the port has into one reusable bytearray and
+hands out complete lines as memoryview slices of it; numeric fields are
+parsed straight from those bytes.
+
+    framer = LineFramer()
+    for line in framer.read_lines(ser):   # memoryviews, valid until the next read
+        if line[:2] == b"X:":
+            position = parse_axes(line)
+
+Shared by the motor controller and the scale reader.
+"""
+import re
+
+_WHITESPACE = b" \t\r\n"
+
+# 'X:12.50' style fields of an M114 / auto-report position line
+_AXIS_FIELD = re.compile(rb"([A-Z]):(-?\d+(?:\.\d*)?)")
+_COUNT = re.compile(rb"Count")
+
+# First number on a line (scale output such as '  +12.3456 g')
+_NUMBER = re.compile(rb"[-+]?\d*\.\d+|\d+")
+
+
+class LineFramer:
+    """Splits a byte stream into lines inside a single reusable buffer.
+
+    Lines are returned as memoryview slices without the line ending or
+    surrounding whitespace; empty lines are skipped. A slice is only valid
+    until the next read, which may move the buffered bytes.
+    """
+
+    def __init__(self, size=4096):
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0  # first unconsumed byte
+        self._end = 0    # end of received data
+
+    def clear(self):
+        """Forget everything buffered (e.g. together with ser.reset_input_buffer())."""
+        self._start = self._end = 0
+
+    def buffered(self):
+        """Bytes received but not yet returned as a line."""
+        return self._end - self._start
+
+    def _make_room(self, count):
+        if self._end + count <= len(self._buf):
+            return
+        # Move the unfinished line to the front; grow only if it still does not fit
+        pending = self._end - self._start
+        if pending + count > len(self._buf):
+            self._view.release()
+            grown = bytearray(max(2 * len(self._buf), pending + count))
+            grown[:pending] = self._buf[self._start:self._end]
+            self._buf = grown
+            self._view = memoryview(self._buf)
+        else:
+            self._buf[:pending] = self._buf[self._start:self._end]
+        self._start, self._end = 0, pending
+
+    def fill(self, ser, block=True):
+        """Read what the port has waiting; with `block`, wait (up to the port
+        timeout) for at least one byte. Returns the number of bytes read."""
+        count = ser.in_waiting
+        if not count:
+            if not block:
+                return 0
+            count = 1
+        self._make_room(count)
+        received = ser.readinto(self._view[self._end:self._end + count])
+        self._end += received or 0
+        return received or 0
+
+    def lines(self):
+        """Yield every complete buffered line and consume it."""
+        buf = self._buf
+        while True:
+            newline = buf.find(b"\n", self._start, self._end)
+            if newline < 0:
+                return
+            start, end = self._start, newline
+            self._start = newline + 1
+            while start < end and buf[start] in _WHITESPACE:
+                start += 1
+            while end > start and buf[end - 1] in _WHITESPACE:
+                end -= 1
+            if end > start:
+                yield self._view[start:end]
+
+    def read_lines(self, ser, block=True):
+        """Read from the port and return the complete lines received so far."""
+        self.fill(ser, block)
+        return list(self.lines())
+
+    def next_line(self, ser):
+        """Return the next line, reading as needed; None if the port timed out."""
+        while True:
+            for line in self.lines():
+                return line
+            if not self.fill(ser, block=True):
+                return None
+
+
+def parse_axes(line):
+    """{axis: float} for the 'X:.. Y:..' fields of a position line, ignoring the
+    stepper 'Count X:..' part of M114 replies. Works on bytes or a memoryview."""
+    count = _COUNT.search(line)
+    end = count.start() if count else len(line)
+    return {name.decode(): float(value) for name, value in _AXIS_FIELD.findall(line, 0, end)}
+
+
+def parse_number(line):
+    """First number in a line as a float; ValueError if there is none."""
+    match = _NUMBER.search(line)
+    if match is None:
+        raise ValueError(f"Cannot parse number from {bytes(line)!r}")
+    return float(match.group(0))
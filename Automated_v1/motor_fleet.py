@@ -0,0 +1,125 @@
+# motor_fleet.py
+"""
+Drive several motor boards (one per dispensing station) from one process.
+
+Every board gets its own worker thread, so a slow command or a long wait on
+one station never holds up the others, while commands for the same board
+still run strictly in the order they were given. Calls fan out to the
+boards and return futures; gather() collects them, and barrier() lines all
+boards up before any of them goes on.
+
+    fleet = MotorFleet.from_ports({'cell1': 'COM4', 'cell2': 'COM7'})
+    fleet.move({'cell1': ('E1', 3000, 2000), 'cell2': ('E1', 2500, 2000)})
+    fleet.barrier()                  # both stations idle before the next step
+
+    # One full protocol per station, concurrently
+    runs = {name: fleet.submit(name, lambda c, port=port: automated_pipeline(80, 8, 40, motor=c, scale_port=port))
+            for name, port in {'cell1': 'COM5', 'cell2': 'COM8'}.items()}
+    print(fleet.gather(runs))
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import connections
+
+
+class MotorFleet:
+    """Named MotorControllers, each with a single worker thread."""
+
+    def __init__(self, controllers):
+        if not controllers:
+            raise ValueError("MotorFleet needs at least one controller")
+        self.controllers = dict(controllers)
+        self._workers = {name: ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"fleet-{name}")
+                         for name in self.controllers}
+
+    @classmethod
+    def from_ports(cls, ports, **kwargs):
+        """Fleet of the shared controllers (see connections.motor) on {name: port}."""
+        return cls({name: connections.motor(port, **kwargs) for name, port in ports.items()})
+
+    def __len__(self):
+        return len(self.controllers)
+
+    def __getitem__(self, name):
+        return self.controllers[name]
+
+    def _names(self, boards):
+        if boards is None:
+            return list(self.controllers)
+        unknown = [name for name in boards if name not in self.controllers]
+        if unknown:
+            raise KeyError(f"Unknown board(s): {', '.join(unknown)}")
+        return list(boards)
+
+    def submit(self, name, fn, *args, **kwargs):
+        """Run fn(controller, *args, **kwargs) on board `name`'s worker; returns a Future."""
+        return self._workers[name].submit(fn, self.controllers[name], *args, **kwargs)
+
+    def run(self, fn, *args, boards=None, **kwargs):
+        """Fan fn(controller, *args, **kwargs) out to every board (or `boards`).
+        Returns {name: Future}."""
+        return {name: self.submit(name, fn, *args, **kwargs) for name in self._names(boards)}
+
+    def call(self, method, *args, boards=None, **kwargs):
+        """Call MotorController.`method` on every board; returns {name: Future}."""
+        return self.run(lambda controller: getattr(controller, method)(*args, **kwargs), boards=boards)
+
+    def move(self, moves):
+        """Queue one relative move per board: {name: (motor, steps, feedrate)}.
+        Returns {name: Future of the move's MotionHandle}."""
+        return {name: self.submit(name, lambda c, move=move: c.move_motor_by_steps(*move))
+                for name, move in moves.items()}
+
+    def send_gcode(self, cmd, boards=None):
+        """Send the same command to every board; returns {name: Future of its response}."""
+        return self.call('send_gcode', cmd, boards=boards)
+
+    def wait_for_motion(self, boards=None, timeout=None):
+        """Block until every board (or `boards`) has finished all queued motion."""
+        return self.gather(self.call('wait_for_motion', boards=boards, timeout=timeout), timeout)
+
+    def barrier(self, boards=None, timeout=None, motion=True):
+        """Queue a rendezvous on every board (or `boards`): work submitted after it
+        starts only once all of them have reached it, with their motion finished
+        when `motion` is set. Returns {name: Future} without blocking."""
+        names = self._names(boards)
+        rendezvous = threading.Barrier(len(names))
+
+        def arrive(controller):
+            if motion:
+                controller.wait_for_motion(timeout=timeout)
+            rendezvous.wait(timeout)
+
+        futures = self.run(arrive, boards=names)
+        for future in futures.values():
+            # A board that fails before arriving must not strand the others
+            future.add_done_callback(lambda f: not f.cancelled() and f.exception() and rendezvous.abort())
+        return futures
+
+    def emergency(self, cmd="M410", boards=None):
+        """Send an emergency command to every board (or `boards`) straight from the
+        calling thread, without waiting behind work queued on the workers.
+        Returns {name: seconds until the line was written}."""
+        return {name: self.controllers[name].emergency(cmd) for name in self._names(boards)}
+
+    @staticmethod
+    def gather(futures, timeout=None):
+        """Wait for {name: Future} and return {name: result}. Raises the first
+        error (in board order) once every future has finished, or TimeoutError."""
+        done, pending = wait(list(futures.values()), timeout)
+        if pending:
+            raise TimeoutError(f"{len(pending)} board(s) still busy after {timeout} s")
+        return {name: future.result() for name, future in futures.items()}
+
+    def close(self):
+        """Stop the workers once their queued work is done. The controllers stay
+        open; they belong to the connection registry or the caller."""
+        for worker in self._workers.values():
+            worker.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,10 +1,316 @@
+import json
+import math
+import queue
+import re
 import serial
+import threading
 import time
+from collections import deque
+
+from line_framer import LineFramer, parse_axes
+
+# Marlin BUFSIZE (Configuration_adv.h): commands the firmware can hold before
+# it stops reading the serial port. Keeping this many in flight keeps the
+# planner fed without overrunning the board.
+DEFAULT_WINDOW = 4
+
+# ADVANCED_OK replies look like "ok N12 P15 B3"; B is the free command slots.
+_ADVANCED_OK_FREE = re.compile(r"\bB(\d+)")
+
+# Marlin reads F the LinuxCNC way: it is the speed along the XYZ distance, or
+# along E if only the extruder moves.
+FEED_REFERENCE_GROUPS = (('X', 'Y', 'Z'), ('E',))
+
+# Motion limits (stock Marlin Configuration.h of this build), used to predict how
+# long moves take. DEFAULT_MAX_FEEDRATE (mm/s) and DEFAULT_MAX_ACCELERATION
+# (mm/s^2); every E0-E4 tool moves the 'E' axis.
+MAX_FEEDRATE = {'X': 300, 'Y': 300, 'Z': 5, 'E': 25}
+MAX_ACCELERATION = {'X': 3000, 'Y': 3000, 'Z': 100, 'E': 10000}
+DEFAULT_ACCELERATION = 3000          # mm/s^2, moves with linear axes
+DEFAULT_RETRACT_ACCELERATION = 3000  # mm/s^2, E-only moves
+DEFAULT_FEEDRATE = 1500              # mm/min, Marlin's feedrate before the first F word
+
+# Modal commands and the state they put the firmware in
+MODAL_COMMANDS = {
+    'G90': ('positioning', 'absolute'),
+    'G91': ('positioning', 'relative'),
+    'G20': ('units', 'inch'),
+    'G21': ('units', 'mm'),
+}
+
+# 'Resend: 12' (older firmware: 'rs N12') asks the host to go back to line 12
+_RESEND_LINE = re.compile(r"^(?:resend|rs)[:\s]*N?(\d+)", re.IGNORECASE)
+
+# Received lines waiting for the dispatcher thread
+RX_QUEUE_SIZE = 1024
+
+# Line kinds the dispatcher routes to subscribers ('line' receives everything)
+LINE_KINDS = ('ok', 'position', 'busy', 'error', 'echo', 'other', 'line')
+
+# Connect handshake: how long to wait for the board to answer after opening the
+# port, and how often to ask (M115) while it does not
+BOOT_TIMEOUT = 10.0
+PROBE_INTERVAL = 0.5
+
+# Commands the priority lane (MotorController.emergency) may write. Marlin's
+# EMERGENCY_PARSER acts on them as soon as they arrive, ahead of its queue.
+EMERGENCY_COMMANDS = ('M108', 'M410', 'M112')
+# Stops whose cut-short moves MotionHandle.wait() still reports; older ones are forgotten
+CUT_HISTORY = 32
+
+
+def feed_reference_distance(dist_mm):
+    """Distance (mm) that Marlin applies the F word to for a move of `dist_mm` per axis."""
+    for group in FEED_REFERENCE_GROUPS:
+        distance = math.sqrt(sum(dist_mm.get(axis, 0.0) ** 2 for axis in group))
+        if distance > 0:
+            return distance
+    return 0.0
+
+
+def trapezoid_time(distance, speed, accel):
+    """Time (s) to travel `distance` (mm) from rest to rest, cruising at most at
+    `speed` (mm/s) and accelerating at `accel` (mm/s^2)."""
+    if distance <= 0:
+        return 0.0
+    if distance >= speed * speed / accel:
+        return distance / speed + speed / accel
+    return 2.0 * math.sqrt(distance / accel)
+
+
+def gcode_checksum(line):
+    """Marlin line checksum: XOR of every byte before the '*'."""
+    checksum = 0
+    for byte in line.encode(errors="ignore"):
+        checksum ^= byte
+    return checksum
+
+
+def classify_line(line):
+    """Classify one Marlin reply line into one of LINE_KINDS."""
+    lower = line.lower()
+    if lower.startswith("ok"):
+        return 'ok'
+    if line.startswith("X:"):
+        return 'position'
+    # Some firmwares send 'wait' periodically while idle, Marlin sends
+    # 'echo:busy: processing' keepalives while a command blocks
+    if lower.startswith(("busy", "echo:busy", "wait")):
+        return 'busy'
+    if lower.startswith("error") or line.startswith("!!") or lower.startswith("resend"):
+        return 'error'
+    if lower.startswith("echo"):
+        return 'echo'
+    return 'other'
+
+
+class CommandAborted(RuntimeError):
+    """A command was dropped, or cut short on the board, by an emergency stop."""
+
+
+class _Handshake:
+    """Readiness check right after the port is opened.
+
+    M115 probes go out every PROBE_INTERVAL until one is answered. A 'start'
+    banner means the board has just booted and lost every earlier probe, so
+    the next one goes out at once. The board is ready after an 'ok' once no
+    other probe can still be answered, so a late reply is never taken for
+    the 'ok' of a real command.
+    """
+
+    def __init__(self):
+        self.probes = 0
+        self.oks = 0
+        self.booted = False
+        self.sent = None
+
+    def on_line(self, line, kind):
+        if kind == 'ok' and self.oks < self.probes:
+            self.oks += 1
+        elif line == "start":
+            self.probes = self.oks = 0
+            self.booted = True
+
+    def ready(self, now):
+        return self.oks > 0 and (self.oks >= self.probes or now - self.sent > PROBE_INTERVAL)
+
+    def probe_due(self, now):
+        return not self.oks and (self.sent is None or self.booted or now - self.sent >= PROBE_INTERVAL)
+
+    def probe_sent(self, now):
+        self.probes += 1
+        self.sent = now
+        self.booted = False
+
+
+class _PendingCommand:
+    """A command written to the board that has not been acknowledged yet."""
+    __slots__ = ("cmd", "response", "done", "aborted", "line_no", "framed", "resend", "closes",
+                 "t_enqueue", "t_write", "t_first", "t_ok")
+
+    def __init__(self, cmd, line_no=None, framed=None):
+        self.cmd = cmd
+        self.response = []
+        self.done = False
+        self.aborted = False  # in flight when an emergency stop was sent
+        # perf_counter() stamps for latency instrumentation
+        self.t_enqueue = self.t_write = self.t_first = self.t_ok = None
+        # Reliable mode: line number, the exact line written, and whether the
+        # board asked for it again
+        self.line_no = line_no
+        self.framed = framed
+        self.resend = False
+        # M400: (motion seq, predicted end) of the moves its 'ok' confirms finished
+        self.closes = None
+
+
+class LatencyHistogram:
+    """HDR-style histogram of durations.
+
+    Values are kept in microseconds in log-linear buckets: every power of two is
+    split into SUB_BUCKETS bins, so a value is recorded to within 1/SUB_BUCKETS
+    (about 3 %) whatever its magnitude, in a few dozen counters.
+    """
+    SUB_BUCKETS = 32
+
+    def __init__(self):
+        self.counts = {}  # bucket lower bound (us) -> count
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    @classmethod
+    def _bucket(cls, us):
+        shift = max(0, us.bit_length() - cls.SUB_BUCKETS.bit_length())
+        return (us >> shift) << shift, 1 << shift
+
+    def record(self, seconds):
+        us = max(0, int(seconds * 1e6))
+        low, _ = self._bucket(us)
+        self.counts[low] = self.counts.get(low, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        """Highest value (s) in the bucket holding the p-th percentile."""
+        if not self.count:
+            return 0.0
+        target = max(1, math.ceil(p / 100.0 * self.count))
+        seen = 0
+        for low in sorted(self.counts):
+            seen += self.counts[low]
+            if seen >= target:
+                _, width = self._bucket(low)
+                return min(self.max, (low + width - 1) / 1e6)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class LatencyRecorder:
+    """Per-command timing for MotorController(instrument=...), grouped by G-code verb.
+
+    For every acknowledged command it records, from time.perf_counter() stamps:
+    - queue:      enqueue -> written (waiting for an 'ok' credit)
+    - first_byte: written -> first reply line
+    - ok:         written -> 'ok'
+    Also totals the controller's deliberate sleeps and the time callers spent
+    blocked waiting on the firmware (credits, replies, M400).
+    """
+    STAGES = ('queue', 'first_byte', 'ok')
+
+    def __init__(self):
+        self.started = time.time()
+        self.verbs = {}  # verb -> {stage: LatencyHistogram}
+        self.sleep_time = 0.0
+        self.sleep_count = 0
+        self.firmware_wait = 0.0
+
+    def record(self, pending):
+        if pending.t_enqueue is None or pending.t_write is None:
+            return  # never went through queue_gcode's stamping
+        verb = pending.cmd.split()[0].upper() if pending.cmd.split() else "?"
+        stages = self.verbs.setdefault(verb, {stage: LatencyHistogram() for stage in self.STAGES})
+        stages['queue'].record(pending.t_write - pending.t_enqueue)
+        if pending.t_first is not None:
+            stages['first_byte'].record(pending.t_first - pending.t_write)
+        stages['ok'].record(pending.t_ok - pending.t_write)
+
+    def summary(self):
+        return {
+            'started': time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            'elapsed': time.time() - self.started,
+            'sleep_time': self.sleep_time,
+            'sleep_count': self.sleep_count,
+            'firmware_wait': self.firmware_wait,
+            'verbs': {verb: {stage: hist.summary() for stage, hist in stages.items()}
+                      for verb, stages in sorted(self.verbs.items())},
+        }
+
+    def report(self):
+        """Human-readable table of the summary."""
+        s = self.summary()
+        lines = [f"Latency over {s['elapsed']:.1f} s: {s['sleep_time']:.2f} s in {s['sleep_count']} sleeps, "
+                 f"{s['firmware_wait']:.2f} s waiting on firmware",
+                 f"{'verb':<6} {'n':>6} {'ok p50':>9} {'p95':>9} {'p99':>9} {'max':>9} {'queue p95':>10}  (ms)"]
+        for verb, stages in s['verbs'].items():
+            ok, queued = stages['ok'], stages['queue']
+            lines.append(f"{verb:<6} {ok['count']:>6} {ok['p50'] * 1e3:>9.2f} {ok['p95'] * 1e3:>9.2f} "
+                         f"{ok['p99'] * 1e3:>9.2f} {ok['max'] * 1e3:>9.2f} {queued['p95'] * 1e3:>10.2f}")
+        return "\n".join(lines)
+
+    def save(self, path, **meta):
+        """Write the summary (plus `meta`, e.g. port or firmware) as JSON."""
+        with open(path, "w") as f:
+            json.dump(dict(meta, **self.summary()), f, indent=2)
+
+
+class MotionHandle:
+    """Completion handle for a queued move.
+
+    The move has been written to the board when the handle is returned;
+    wait() blocks until the board reports all motion up to this move finished
+    (M400 acknowledged), so callers wait exactly as long as the move takes.
+    """
+
+    def __init__(self, controller, seq, command, eta=None):
+        self.controller = controller
+        self.seq = seq
+        self.command = command
+        self.eta = eta  # predicted time.monotonic() at which the move finishes
+
+    def remaining(self):
+        """Predicted seconds until the move finishes (0 once it should be done)."""
+        if self.eta is None:
+            return 0.0
+        return max(0.0, self.eta - time.monotonic())
+
+    def done(self):
+        """True once the board has confirmed the move finished. Safe to poll:
+        once the predicted end has passed, it queues one M400 to find out."""
+        return self.controller._poll_motion(self)
+
+    def wait(self, timeout=None):
+        self.controller.wait_for_motion(self.seq, timeout=timeout)
+        return self
+
 
 class MotorController:
-    def __init__(self, port='COM4', baudrate=115200):
+    def __init__(self, port='COM4', baudrate=115200, window=DEFAULT_WINDOW, reliable=False, instrument=False):
         self.ser = serial.Serial(port, baudrate, timeout=2)
-        time.sleep(2)  # Wait for board to initialize
+
+        # Opt-in latency instrumentation: True, or a path to also save it as JSON at close()
+        self.latency = LatencyRecorder() if instrument else None
+        self._latency_path = instrument if isinstance(instrument, str) else None
 
         # Track positions for all motors
         self.current_position = {'X': 0, 'Y': 0, 'Z': 0}
@@ -19,45 +325,696 @@ class MotorController:
             **{f'E{i}': 500 for i in range(5)}  # E0-E4
         }
 
-    def send_gcode(self, cmd):
-        # print(f">> {cmd}")
+        # Streaming state: commands written but not yet answered with 'ok'.
+        # _cond guards it; the dispatcher thread notifies on every 'ok'.
+        self.window = max(1, int(window))
+        self._inflight = deque()
+        self._free_slots = None  # last ADVANCED_OK 'B' value, if the firmware sends it
+        self._cond = threading.Condition()
+
+        # Modal state cache (positioning, units, tool, feedrate) built from every
+        # command sent; empty means unknown, so the next mode command is sent
+        self._modal = {}
+        self.modal_skips = 0  # mode commands elided because nothing would change
+
+        # Reliable transport: 'N<line> <cmd>*<checksum>' framing and Resend recovery
+        self.reliable = reliable
+        self._line_no = 0
+        self._stray_oks = 0  # 'ok's that answer a Resend/M110, not a queued command
+        self._resending = 0  # in-flight lines the board asked for again, not yet rewritten
+        self.resend_count = 0
+
+        # Motion completion tracking: every queued move gets a sequence number
+        self._motion_seq = 0
+        self._motion_done_seq = 0
+
+        # Motion time prediction: where the planner will be once every queued move
+        # has run, and when that should be. motion_scale/motion_overhead come from
+        # calibrate_motion() and correct the trapezoid model to the real board.
+        self._planned_position = {}
+        self._motion_eta = 0.0
+        self.motion_scale = 1.0
+        self.motion_overhead = 0.0
+
+        # Position auto-report (M154): the board pushes position lines, so
+        # current_position stays fresh without M114 round trips.
+        # axis_stopped[axis] is set once the axis' last queued move is over: predicted
+        # from the motion model, checked whenever a line arrives, confirmed by M400.
+        self.auto_report = False
+        self.axis_stopped = {axis: threading.Event() for axis in MAX_FEEDRATE}
+        for event in self.axis_stopped.values():
+            event.set()
+        self._axis_eta = {}
+
+        # Priority lane (emergency()): every stop bumps _aborts, so commands still
+        # waiting for a credit know they were dropped
+        self._aborts = 0
+        self._cut_motion = []  # (after, up to) motion sequence ranges a stop cut short
+        self.halted = False  # M112 sent: the board ignores everything until reset
+        self.emergency_latency = LatencyHistogram()  # call to line written, seconds
+
+        # Firmware identity and 'Cap:' flags, from the first M115 reply
+        self.firmware_info = None
+        self.capabilities = {}
+        self._handshake = None
+
+        # Reader thread drains the port into a bounded queue, dispatcher thread
+        # routes each line to the in-flight command and to subscribers
+        self._subscribers = {kind: [] for kind in LINE_KINDS}
+        self._subscribers['sent'] = []  # commands as they are written
+        self._rx_queue = queue.Queue(maxsize=RX_QUEUE_SIZE)
+        self._running = True
+        self._reader = threading.Thread(target=self._reader_loop, name="marlin-reader", daemon=True)
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name="marlin-dispatch", daemon=True)
+        self._reader.start()
+        self._dispatcher.start()
+
+        # Wait for the board to answer rather than a fixed boot time
+        self.connect_time = self._await_ready()
+
+        if reliable:
+            self.send_gcode("M110 N0")  # Start line numbering from 0
+
+    def _write_line(self, cmd):
         self.ser.write((cmd + "\n").encode())
         self.ser.flush()
-        response = []
+
+    def _reader_loop(self):
+        """Reader thread: frame the bytes from the port into lines for the receive queue.
+
+        Lines are cut out of one reusable buffer (see line_framer) instead of
+        pyserial's byte-at-a-time readline(); position reports are parsed from
+        the raw bytes here, so the dispatcher gets the numbers ready-made.
+        """
+        framer = LineFramer()
+        ser = None
+        while self._running:
+            try:
+                if self.ser is not ser:
+                    # New or reopened port: drop any half line from the old one
+                    ser = self.ser
+                    framer.clear()
+                framer.fill(ser)
+            except Exception:
+                # Port closed or being reopened
+                if not self._running:
+                    break
+                time.sleep(0.1)
+                continue
+            received = time.perf_counter()
+            for raw in framer.lines():
+                fields = parse_axes(raw) if raw[:2] == b"X:" else None
+                # Blocks when the queue is full, so lines back up in the OS buffer
+                # instead of being dropped
+                self._rx_queue.put((received, str(raw, "ascii", "ignore"), fields))
+        self._rx_queue.put(None)
+
+    def _dispatch_loop(self):
+        """Dispatcher thread: route received lines to in-flight commands and subscribers."""
         while True:
-            line = self.ser.readline().decode(errors="ignore").strip()
-            if line:
-                # print(f"<< {line}")
-                response.append(line)
-                if line.startswith("X:"):
-                    try:
-                        parts = line.split()
-                        for part in parts:
-                            if ':' in part:
-                                name, value = part.split(':')
-                                if name in self.current_position:
-                                    self.current_position[name] = float(value)
-                    except Exception as e:
-                        print(f"Error parsing position: {e}")
-            if line.lower().startswith("ok"):
+            item = self._rx_queue.get()
+            if item is None:
                 break
-        return response
+            try:
+                self._dispatch(item[1], item[0], item[2])
+            except Exception as e:
+                # One bad line must not take the dispatcher, and every waiter, down with it
+                print(f"[ERROR] handling '{item[1]}' failed: {e!r}")
+                with self._cond:
+                    self._cond.notify_all()
+
+    def _dispatch(self, line, received=None, fields=None):
+        # print(f"<< {line}")
+        kind = classify_line(line)
+        with self._cond:
+            if line.startswith("FIRMWARE_NAME:"):
+                self.firmware_info = line
+            elif line.startswith("Cap:"):
+                name, _, value = line[4:].partition(':')
+                self.capabilities[name] = value == '1'
+            if self._handshake is not None:
+                # Board still being brought up: lines answer the probes, not queued commands
+                self._handshake.on_line(line, kind)
+                self._cond.notify_all()
+            else:
+                pending = self._inflight[0] if self._inflight else None
+                if pending is not None:
+                    if not pending.response:
+                        pending.t_first = received
+                    pending.response.append(line)
+                if kind == 'position':
+                    self._update_position(line, fields)
+                elif line == "start":
+                    # Board rebooted: modal state and auto-report are back to firmware defaults
+                    self._modal.clear()
+                    self.auto_report = False
+                    self.halted = False
+                elif kind == 'error' and _RESEND_LINE.match(line):
+                    self._handle_resend(int(_RESEND_LINE.match(line).group(1)))
+                elif kind == 'ok':
+                    match = _ADVANCED_OK_FREE.search(line)
+                    if match:
+                        self._free_slots = int(match.group(1))
+                    if self._stray_oks:
+                        self._stray_oks -= 1
+                    elif pending is not None:
+                        pending.done = True
+                        self._inflight.popleft()
+                        if pending.closes is not None and not pending.aborted:
+                            self._motion_finished(*pending.closes)
+                        if self.latency is not None:
+                            pending.t_ok = received or time.perf_counter()
+                            self.latency.record(pending)
+                        if self._resending:
+                            self._resend_next()
+                    self._cond.notify_all()
+            if self._axis_eta:
+                self._check_stopped()
+        for callback in list(self._subscribers[kind]) + list(self._subscribers['line']):
+            try:
+                callback(line)
+            except Exception as e:
+                print(f"[WARN] subscriber failed on '{line}': {e}")
+
+    def _frame(self, cmd):
+        """Number and checksum a command: 'N<line> <cmd>*<checksum>'."""
+        if cmd.upper().startswith("M110"):
+            # M110 sets the line number itself
+            match = re.search(r"N(-?\d+)", cmd[4:])
+            self._line_no = int(match.group(1)) if match else 0
+        else:
+            self._line_no += 1
+        body = f"N{self._line_no} {cmd}"
+        return f"{body}*{gcode_checksum(body)}"
+
+    def _handle_resend(self, line_no):
+        """Answer a Marlin 'Resend: n'. Called by the dispatcher with _cond held.
+
+        Marlin empties its receive buffer on every line error, so lines written
+        after n are lost too, and lines still in transit each trigger another
+        request. Recovery therefore goes back to line n and rewrites one line per
+        'ok' until it catches up. A line that arrives twice is harmless: Marlin
+        silently drops a line number it has just accepted.
+        """
+        # Every Resend is followed by an 'ok' that completes nothing
+        self._stray_oks += 1
+        numbered = [p for p in self._inflight if p.line_no is not None]
+        lines = [p for p in numbered if p.line_no >= line_no]
+        if not lines:
+            # The board lost the numbering (e.g. a corrupted M110 asks for a line we
+            # never sent): replay everything it has not acknowledged yet
+            lines = numbered
+        if not lines:
+            print(f"[ERROR] board asked to resend line {line_no}, but nothing is in flight")
+            return
+        print(f"[WARN] resending from line {lines[0].line_no}")
+        self.resend_count += 1
+        for pending in lines:
+            if not pending.resend:
+                pending.resend = True
+                self._resending += 1
+        self._resend_next()
+
+    def _resend_next(self):
+        """Rewrite the oldest line still marked for resend."""
+        for pending in self._inflight:
+            if pending.resend:
+                pending.resend = False
+                self._resending -= 1
+                self._write_line(pending.framed)
+                return
+
+    def subscribe(self, kind, callback):
+        """Call `callback(line)` from the dispatcher thread for every received line of
+        `kind` ('ok', 'position', 'busy', 'error', 'echo', 'other', or 'line' for all).
+        Kind 'sent' instead gets every command this controller writes, from the
+        writing thread. Callbacks must be quick and must not send G-code themselves."""
+        if kind not in self._subscribers:
+            raise ValueError(f"Invalid line kind: {kind}. Must be one of: {', '.join(self._subscribers)}")
+        self._subscribers[kind].append(callback)
+
+    def unsubscribe(self, kind, callback):
+        self._subscribers[kind].remove(callback)
+
+    def _notify_sent(self, cmd):
+        for callback in list(self._subscribers['sent']):
+            try:
+                callback(cmd)
+            except Exception as e:
+                print(f"[WARN] subscriber failed on '{cmd}': {e}")
+
+    def _update_position(self, line, fields=None):
+        """Update current_position from an 'X:.. Y:..' position report
+        (`fields` is the report already parsed by the reader thread)."""
+        try:
+            if fields is None:
+                fields = parse_axes(line.encode())
+            for name, value in fields.items():
+                if name in self.current_position:
+                    self.current_position[name] = value
+        except Exception as e:
+            print(f"Error parsing position: {e}")
+
+    def _credit_limit(self):
+        """How many commands may be in flight right now."""
+        limit = self.window
+        if self._free_slots is not None:
+            # ADVANCED_OK tells us how much room the command queue really has
+            limit = min(limit, max(1, self._free_slots))
+        return limit
+
+    def _wait_done(self, pending, deadline=None):
+        """Wait until `pending` is acknowledged; returns False on deadline."""
+        start = time.perf_counter()
+        try:
+            with self._cond:
+                while not pending.done:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+                if pending.aborted:
+                    raise CommandAborted(f"'{pending.cmd}' was cut short by an emergency stop")
+            return True
+        finally:
+            if self.latency is not None:
+                self.latency.firmware_wait += time.perf_counter() - start
+
+    def _await_ready(self, timeout=BOOT_TIMEOUT):
+        """Block until the board answers M115 (see _Handshake); returns the seconds
+        it took, or None after warning if it stays silent for `timeout` seconds."""
+        start = time.monotonic()
+        deadline = start + timeout
+        with self._cond:
+            self._handshake = handshake = _Handshake()
+            try:
+                while True:
+                    now = time.monotonic()
+                    if handshake.ready(now):
+                        return now - start
+                    if now >= deadline:
+                        print(f"[WARN] no answer from {self.ser.port} after {timeout:g} s; continuing anyway")
+                        return None
+                    if handshake.probe_due(now):
+                        # Written directly: the probe is not a queued command
+                        self.ser.write(b"M115\r\n")
+                        handshake.probe_sent(now)
+                    self._cond.wait(min(PROBE_INTERVAL, deadline - now))
+            finally:
+                self._handshake = None
+
+    def _sleep(self, seconds):
+        """Deliberate pause, counted separately from firmware waits when instrumented."""
+        time.sleep(seconds)
+        if self.latency is not None:
+            self.latency.sleep_time += seconds
+            self.latency.sleep_count += 1
+
+    def queue_gcode(self, cmd):
+        """Write a command as soon as an 'ok' credit is available and return without
+        waiting for its reply. Up to `window` commands are kept in flight."""
+        enqueued = time.perf_counter()
+        with self._cond:
+            aborts = self._aborts
+            # New lines wait while a resend is catching up
+            while (len(self._inflight) >= self._credit_limit() or self._resending) and aborts == self._aborts:
+                self._cond.wait()
+            if aborts != self._aborts or self.halted:
+                raise CommandAborted(f"'{cmd}' was dropped by an emergency stop")
+            if self.latency is not None:
+                self.latency.firmware_wait += time.perf_counter() - enqueued
+            cmd = self._elide_feedrate(cmd)
+            # print(f">> {cmd}")
+            if self.reliable:
+                line = self._frame(cmd)
+                pending = _PendingCommand(cmd, self._line_no, line)
+            else:
+                line = cmd
+                pending = _PendingCommand(cmd)
+            pending.t_enqueue = enqueued
+            if cmd.split()[:1] == ["M400"]:
+                # Every move queued so far is over once this is acknowledged
+                pending.closes = (self._motion_seq, self._motion_eta)
+            self._inflight.append(pending)
+            try:
+                self._write_line(line)
+                pending.t_write = time.perf_counter()
+            except Exception:
+                self._inflight.remove(pending)
+                if self.reliable:
+                    # Give the line number back so numbering stays contiguous
+                    self._line_no -= 1
+                raise
+            self._track_modal(cmd)
+            self._predict_motion(cmd)
+        if self._subscribers['sent']:
+            self._notify_sent(cmd)
+        return pending
+
+    def _track_modal(self, cmd):
+        """Record the modal state a command leaves the firmware in."""
+        words = cmd.split()
+        if not words:
+            return
+        head = words[0].upper()
+        if head in MODAL_COMMANDS:
+            key, value = MODAL_COMMANDS[head]
+            self._modal[key] = value
+        elif head[0] == 'T' and head[1:].isdigit():
+            self._modal['tool'] = int(head[1:])
+        elif head in ('G0', 'G1'):
+            for word in words[1:]:
+                if word[0].upper() == 'F':
+                    try:
+                        self._modal['feedrate'] = float(word[1:])
+                    except ValueError:
+                        self._modal.pop('feedrate', None)
+
+    def _elide_feedrate(self, cmd):
+        """Drop the F word of a G0/G1 when the firmware already uses that feedrate."""
+        words = cmd.split()
+        if len(words) < 3 or words[0].upper() not in ('G0', 'G1') or 'feedrate' not in self._modal:
+            return cmd
+        kept = []
+        for word in words[1:]:
+            if word[0].upper() == 'F':
+                try:
+                    if float(word[1:]) == self._modal['feedrate']:
+                        continue
+                except ValueError:
+                    pass
+            kept.append(word)
+        return " ".join([words[0]] + kept)
+
+    def predict_move_time(self, dist_mm, feedrate=None, calibrated=True):
+        """Predicted duration (s) of one move of `dist_mm` per axis, e.g. {'E': 4.0}.
+
+        Follows the Marlin planner: F (mm/min, default the current feedrate) applies
+        to the feed reference distance, every axis is held to its max feedrate and
+        acceleration, and the move is a trapezoid starting and ending at rest.
+        Junction speeds between consecutive moves are ignored; with junction
+        deviation and different pumps per move they are close to zero anyway.
+        """
+        length = feed_reference_distance(dist_mm)
+        if length == 0:
+            return 0.0
+        if feedrate is None:
+            feedrate = self._modal.get('feedrate', DEFAULT_FEEDRATE)
+        speed = feedrate / 60.0
+        accel = DEFAULT_RETRACT_ACCELERATION if set(dist_mm) <= {'E'} else DEFAULT_ACCELERATION
+        for axis, mm in dist_mm.items():
+            share = abs(mm) / length
+            if share > 0:
+                speed = min(speed, MAX_FEEDRATE[axis] / share)
+                accel = min(accel, MAX_ACCELERATION[axis] / share)
+        seconds = trapezoid_time(length, speed, accel)
+        if calibrated:
+            seconds = seconds * self.motion_scale + self.motion_overhead
+        return seconds
+
+    def _axis_values(self, words):
+        """{axis: mm} for the axis words of a split command."""
+        scale = 25.4 if self._modal.get('units') == 'inch' else 1.0
+        values = {}
+        for word in words[1:]:
+            axis = word[0].upper()
+            if axis in MAX_FEEDRATE:
+                try:
+                    values[axis] = float(word[1:]) * scale
+                except ValueError:
+                    pass
+        return values
+
+    def _predict_motion(self, cmd):
+        """Advance the predicted motion end time by a command just queued.
+        Called with _cond held. G28 only resets the planned position; how long
+        homing takes depends on where the endstops are, so it is not predicted."""
+        words = cmd.split()
+        if not words:
+            return
+        head = words[0].upper()
+        planned = self._planned_position
+        if head in ('G0', 'G1'):
+            dist = {}
+            for axis, value in self._axis_values(words).items():
+                start = planned.get(axis, 0.0)
+                target = start + value if self._modal.get('positioning') == 'relative' else value
+                if target != start:
+                    dist[axis] = target - start
+                planned[axis] = target
+            if dist:
+                start = max(time.monotonic(), self._motion_eta)
+                self._motion_eta = start + self.predict_move_time(dist)
+                for axis in dist:
+                    self._axis_eta[axis] = self._motion_eta
+                    self.axis_stopped[axis].clear()
+        elif head == 'G4':
+            # Dwell: P milliseconds or S seconds
+            for word in words[1:]:
+                unit = {'P': 0.001, 'S': 1.0}.get(word[0].upper())
+                if unit:
+                    try:
+                        start = max(time.monotonic(), self._motion_eta)
+                        self._motion_eta = start + float(word[1:]) * unit
+                    except ValueError:
+                        pass
+        elif head == 'G92':
+            planned.update(self._axis_values(words))
+        elif head == 'G28':
+            homed = [w[0].upper() for w in words[1:] if w[0].upper() in MAX_FEEDRATE and w[0].upper() != 'E']
+            for axis in homed or [axis for axis in MAX_FEEDRATE if axis != 'E']:
+                planned[axis] = 0.0
+
+    def _check_stopped(self, confirmed=None):
+        """Set axis_stopped for every axis whose last move should be over by now, or
+        was queued before a motion end time `confirmed` by M400. Called with _cond held."""
+        limit = time.monotonic()
+        if confirmed is not None:
+            limit = max(limit, confirmed)
+        for axis, eta in list(self._axis_eta.items()):
+            if eta <= limit:
+                del self._axis_eta[axis]
+                self.axis_stopped[axis].set()
+
+    def motion_eta(self):
+        """Predicted time.monotonic() at which every queued move has finished."""
+        return max(time.monotonic(), self._motion_eta)
+
+    def planned_position(self, axis=None):
+        """Where `axis` (mm; all axes as a dict if None) will be once every queued
+        move has run. After a quickstop, where the motors stopped."""
+        with self._cond:
+            if axis is None:
+                return dict(self._planned_position)
+            return self._planned_position.get(axis, 0.0)
+
+    def calibrate_motion(self, motor, trials=((800, 500), (8000, 1000), (24000, 2000)), repeats=2):
+        """Fit the motion model to the real board from measured M400 latencies.
+
+        Moves `motor` by +steps and back by -steps for every (steps, feedrate) in
+        `trials`, timing each move from queueing to the M400 'ok', and fits
+        measured = motion_scale * predicted + motion_overhead by least squares.
+        Returns (motion_scale, motion_overhead); both are stored on the controller.
+        """
+        self.wait_for_motion()
+        self.set_relative_positioning()
+        samples = []
+        for _ in range(repeats):
+            for steps, feedrate in trials:
+                for direction in (1, -1):
+                    lines = self.steps_to_gcode(motor, direction * steps, feedrate)
+                    for line in lines[:-1]:
+                        self.send_gcode(line)  # tool selection
+                    mm = direction * steps / self.steps_per_mm[motor]
+                    predicted = self.predict_move_time({motor[0]: mm}, feedrate, calibrated=False)
+                    start = time.monotonic()
+                    self._queue_motion(lines[-1]).wait()
+                    samples.append((predicted, time.monotonic() - start))
+
+        n = len(samples)
+        mean_p = sum(p for p, _ in samples) / n
+        mean_m = sum(m for _, m in samples) / n
+        var_p = sum((p - mean_p) ** 2 for p, _ in samples)
+        if var_p > 0:
+            scale = sum((p - mean_p) * (m - mean_m) for p, m in samples) / var_p
+        else:
+            scale = 1.0
+        self.motion_scale = scale
+        self.motion_overhead = mean_m - scale * mean_p
+        worst = max(abs(self.motion_scale * p + self.motion_overhead - m) for p, m in samples)
+        print(f"Motion model: scale {self.motion_scale:.4f}, overhead {self.motion_overhead * 1000:.1f} ms, "
+              f"worst residual {worst * 1000:.1f} ms over {n} moves")
+        return self.motion_scale, self.motion_overhead
+
+    def emergency(self, cmd="M410", reconcile=True):
+        """Priority lane: write M108, M410 or M112 right now, from any thread.
+
+        The line skips the 'ok' credits and everything waiting for one; it only
+        waits for a line already being written. M410 (quickstop) and M112 (kill)
+        also drop every command still waiting to be sent, and waiting on a
+        command that was in flight raises CommandAborted, since the board cut it
+        short. After M410 the real position is read back (unless `reconcile` is
+        False) so current_position and the motion prediction match where the
+        motors stopped; Marlin refuses new moves for 1 s after a quickstop, so
+        this takes about that long. M112 halts the board until it is reset.
+
+        Needs EMERGENCY_PARSER in the firmware; without it the board reads the
+        line only after the commands already sent. Returns the seconds from the
+        call until the line was written (also recorded in emergency_latency).
+        """
+        start = time.perf_counter()
+        head = cmd.split()[0].upper() if cmd.split() else ""
+        if head not in EMERGENCY_COMMANDS:
+            raise ValueError(f"Not an emergency command: '{cmd}'. Must be one of: {', '.join(EMERGENCY_COMMANDS)}")
+        if self.capabilities and not self.capabilities.get("EMERGENCY_PARSER"):
+            print(f"[WARN] firmware has no EMERGENCY_PARSER; {head} waits behind the commands already sent")
+        with self._cond:
+            if head != 'M108':
+                self._aborts += 1
+                if self._motion_seq > self._motion_done_seq:
+                    self._cut_motion.append((self._motion_done_seq, self._motion_seq))
+                    del self._cut_motion[:-CUT_HISTORY]
+                for pending in self._inflight:
+                    pending.aborted = True
+            if head == 'M112':
+                # A killed board answers nothing more: release every waiter now
+                self.halted = True
+                for pending in self._inflight:
+                    pending.done = True
+                self._inflight.clear()
+                self._resending = 0
+            else:
+                # Acknowledged like any other line, after the ones already in flight
+                pending = _PendingCommand(cmd)
+                pending.t_enqueue = start
+                self._inflight.append(pending)
+            self._write_line(cmd)
+            if head != 'M112':
+                pending.t_write = time.perf_counter()
+            elapsed = time.perf_counter() - start
+            self.emergency_latency.record(elapsed)
+            self._cond.notify_all()
+        self._notify_sent(cmd)
+        if head == 'M410' and reconcile:
+            self.resync_position()
+        return elapsed
+
+    def resync_position(self):
+        """Read the board's position back and take it as the planned position.
+        For when the motors moved without this controller predicting it: a
+        quickstop, or a macro the board ran from its SD card."""
+        self.send_gcode("M400")  # after a quickstop: returns once the board accepts moves again
+        position = {}
+        for line in self.send_gcode("M114"):
+            if line.startswith("X:"):
+                position = parse_axes(line.encode())
+        with self._cond:
+            self._planned_position = position
+            self._motion_eta = time.monotonic()
+            self._axis_eta.clear()
+            for event in self.axis_stopped.values():
+                event.set()
+            self._motion_done_seq = self._motion_seq
+
+    def _send_modal(self, key, value, cmd):
+        """Send a mode command unless the firmware is already in that mode."""
+        if self._modal.get(key) == value:
+            self.modal_skips += 1
+            return None
+        return self.send_gcode(cmd)
+
+    def drain(self):
+        """Block until every in-flight command has been acknowledged."""
+        with self._cond:
+            while self._inflight:
+                self._cond.wait()
+
+    def stream_gcode(self, commands):
+        """Send a sequence of commands back to back, keeping the firmware buffer full.
+        Returns the list of responses, one per command."""
+        pending = [self.queue_gcode(cmd) for cmd in commands]
+        for p in pending:
+            self._wait_done(p)
+        return [p.response for p in pending]
+
+    def send_gcode(self, cmd):
+        """Send one command and wait for its 'ok' (stop-and-wait)."""
+        pending = self.queue_gcode(cmd)
+        self._wait_done(pending)
+        return pending.response
+
+    def _queue_motion(self, cmd):
+        """Queue a move and return a MotionHandle for it."""
+        self.queue_gcode(cmd)
+        with self._cond:
+            self._motion_seq += 1
+            return MotionHandle(self, self._motion_seq, cmd, self._motion_eta)
+
+    def wait_for_motion(self, seq=None, timeout=None):
+        """Block until every move up to `seq` (default: all queued moves) has finished.
+        Raises TimeoutError if the board has not confirmed within `timeout` seconds,
+        and CommandAborted if move `seq` (only when given) was cut short by a stop."""
+        if seq is None:
+            # Waiting for the board to be idle: moves a stop cut short are over too
+            seq = self._motion_seq
+        elif any(after < seq <= upto for after, upto in self._cut_motion):
+            raise CommandAborted(f"motion #{seq} was cut short by an emergency stop")
+        if seq <= self._motion_done_seq:
+            return
+        pending = self.queue_gcode("M400")
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not self._wait_done(pending, deadline):
+            raise TimeoutError(f"motion #{seq} not finished after {timeout} s")
+
+    def _motion_finished(self, seq, eta):
+        """An M400 queued after motion #`seq` (predicted to end at `eta`) was
+        acknowledged. Called by the dispatcher with _cond held."""
+        self._motion_done_seq = max(self._motion_done_seq, seq)
+        self._check_stopped(confirmed=eta)
+        if self._motion_eta == eta:
+            # Nothing queued since: the board is idle now, whatever was predicted
+            self._motion_eta = time.monotonic()
+
+    def _poll_motion(self, handle):
+        """MotionHandle.done(): never blocks on the move, at most on a credit for M400."""
+        if handle.seq <= self._motion_done_seq:
+            return True
+        if handle.remaining() > 0:
+            return False
+        with self._cond:
+            asked = any(p.closes is not None and p.closes[0] >= handle.seq for p in self._inflight)
+        if not asked:
+            self.queue_gcode("M400")
+        return handle.seq <= self._motion_done_seq
+
+    def enable_auto_report(self, interval=1, keepalive=None):
+        """Have the board push its position every `interval` seconds (M154, needs
+        AUTO_REPORT_POSITION) and optionally set the 'busy:' keepalive period (M113).
+        Returns False, and keeps polling with M114, if the firmware lacks the feature."""
+        if not self.capabilities:
+            self.send_gcode("M115")
+        if not self.capabilities.get("AUTOREPORT_POS"):
+            print("[WARN] firmware has no AUTO_REPORT_POSITION; position stays polled with M114")
+            return False
+        self.send_gcode(f"M154 S{int(interval)}")
+        if keepalive is not None:
+            self.send_gcode(f"M113 S{int(keepalive)}")
+        self.auto_report = interval > 0
+        return self.auto_report
 
     def enable_steppers(self):
+        # The 'ok' comes once the drivers are enabled; no extra settle time needed
         self.send_gcode("M17")
-        time.sleep(0.5)
 
     def disable_steppers(self):
+        # M18 finishes queued moves before disabling, and only then answers 'ok'
         self.send_gcode("M18")
-        time.sleep(0.5)
 
     def set_absolute_positioning(self):
-        self.send_gcode("G90")
-        time.sleep(0.5)
+        self._send_modal('positioning', 'absolute', "G90")
 
     def set_relative_positioning(self):
-        self.send_gcode("G91")
-        time.sleep(0.5)
+        self._send_modal('positioning', 'relative', "G91")
 
     def set_current_position(self, x=0, y=0, z=0, e_values=None):
         cmd = f"G92 X{x} Y{y} Z{z}"
@@ -66,8 +1023,12 @@ class MotorController:
         for i in range(5):
             cmd += f" E{e_values.get(f'E{i}', 0)}"
         self.send_gcode(cmd)
-        time.sleep(0.5)
-        self.get_position()
+        if self.auto_report:
+            # G92 sets exactly these values; no need to read them back
+            self.current_position.update({'X': x, 'Y': y, 'Z': z})
+            self.current_position.update({f'E{i}': e_values.get(f'E{i}', 0) for i in range(5)})
+        else:
+            self.get_position()
 
     def get_position(self):
         self.send_gcode("M114")
@@ -79,30 +1040,37 @@ class MotorController:
     def select_extruder(self, index):
         if not (0 <= index <= 4):
             raise ValueError("Extruder index must be between 0 and 4.")
-        self.send_gcode(f"T{index}")
-        time.sleep(0.2)
+        self._send_modal('tool', index, f"T{index}")
 
-    def move_motor_by_steps(self, motor_name, step_count, feedrate=1000):
-        """Move a specified motor by step count."""
+    def steps_to_gcode(self, motor_name, step_count, feedrate=1000):
+        """Build the G-code lines (tool select + G1) for a relative move of a motor
+        by step count. Assumes relative positioning (G91) is already active."""
         valid_motors = ['X', 'Y', 'Z'] + [f'E{i}' for i in range(5)]
         if motor_name not in valid_motors:
             raise ValueError(f"Invalid motor: {motor_name}. Must be one of: {', '.join(valid_motors)}")
 
         mm = step_count / self.steps_per_mm[motor_name]
-
+        lines = []
         if motor_name.startswith("E"):
-            index = int(motor_name[1])
-            self.select_extruder(index)
+            lines.append(f"T{int(motor_name[1])}")
             axis = "E"
         else:
             axis = motor_name
+        lines.append(f"G1 {axis}{mm:.4f} F{feedrate}")
+        return lines
+
+    def move_motor_by_steps(self, motor_name, step_count, feedrate=1000):
+        """Move a specified motor by step count. Returns a MotionHandle."""
+        gcode = self.steps_to_gcode(motor_name, step_count, feedrate)[-1]
+        mm = step_count / self.steps_per_mm[motor_name]
+
+        if motor_name.startswith("E"):
+            index = int(motor_name[1])
+            self.select_extruder(index)
 
         self.set_relative_positioning()
-        gcode = f"G1 {axis}{mm:.4f} F{feedrate}"
         print(f"\nMoving {motor_name} by {step_count} steps ({mm:.3f} mm)...")
-        self.send_gcode(gcode)
-        time.sleep(1)
-        # return self.get_position()
+        return self._queue_motion(gcode)
 
     def move_to(self, x=None, y=None, z=None, e=None, feedrate=1000):
         cmd = "G1"
@@ -112,12 +1080,24 @@ class MotorController:
         if e is not None: cmd += f" E{e}"
         cmd += f" F{feedrate}"
         print(f"\nExecuting move command: {cmd}")
-        self.send_gcode(cmd)
-        time.sleep(1)
-        # return self.get_position()
+        return self._queue_motion(cmd)
 
     def close(self):
+        self._running = False
+        try:
+            self.ser.cancel_read()
+        except Exception:
+            pass
         self.ser.close()
+        self._reader.join(timeout=3)
+        self._dispatcher.join(timeout=3)
+        if self.emergency_latency.count:
+            print(f"emergency lane, call to line written (s): {self.emergency_latency.summary()}")
+        if self.latency is not None:
+            print(self.latency.report())
+            if self._latency_path:
+                self.latency.save(self._latency_path, port=self.ser.port, window=self.window,
+                                  reliable=self.reliable)
 
 
 def main():
@@ -143,21 +1123,17 @@ def main():
         #controller.move_motor_by_steps('Z', 5000, 2000)
         #controller.move_motor_by_steps('E2', 10000, 1000) #test the volume of the new
         #time.sleep(3)
-        controller.move_motor_by_steps('E1', 400000, 2000)
-        #controller.move_motor_by_steps('Z', -500000, 2000)
-        controller.move_motor_by_steps('E3', -150000, 2000)
-        controller.move_motor_by_steps('E1', 300000, 1000)
-        #controller.move_motor_by_steps('Z', -500000, 2000)
-        controller.move_motor_by_steps('E3', -150000, 2000)
-        controller.move_motor_by_steps('E1', 300000, 2000)
-        #controller.move_motor_by_steps('Z', -500000, 2000)
-        controller.move_motor_by_steps('E3', -150000, 2000)
-        controller.move_motor_by_steps('E1', 300000, 2000)
-        #controller.move_motor_by_steps('Z', -500000, 2000)
-        controller.move_motor_by_steps('E3', -150000, 2000)
-        controller.move_motor_by_steps('E1', 300000, 2000)
-        #controller.move_motor_by_steps('Z', -500000, 2000)
-        controller.move_motor_by_steps('E3', -150000, 2000)
+        # E1/E3 sequence streamed back to back (no serial round-trip gaps between moves)
+        sequence = [('E1', 400000, 2000), ('E3', -150000, 2000),
+                    ('E1', 300000, 1000), ('E3', -150000, 2000),
+                    ('E1', 300000, 2000), ('E3', -150000, 2000),
+                    ('E1', 300000, 2000), ('E3', -150000, 2000),
+                    ('E1', 300000, 2000), ('E3', -150000, 2000)]
+        gcode = ["G91"]
+        for motor, steps, feedrate in sequence:
+            gcode += controller.steps_to_gcode(motor, steps, feedrate)
+        gcode.append("M400")  # 等待全部动作完成
+        controller.stream_gcode(gcode)
 
         #controller.move_motor_by_steps('Y', 1053, 2000)
         #time.sleep(20)
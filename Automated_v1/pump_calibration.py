@@ -0,0 +1,207 @@
+# pump_calibration.py
+"""
+Pump constants fitted online from the dispenses the pipeline already makes.
+
+Every dispense is appended to a JSON-lines file as (time, pump, steps,
+feedrate, grams) and folded into a per-pump recursive least squares fit of
+
+    grams = steps / 1000 * (a + b * feedrate / 1000)
+
+so the rate may depend (linearly) on the feedrate. A forgetting factor lets
+the fit follow a pump that slowly changes (tubing wear, temperature). Two
+things are flagged:
+
+* drift: the last DRIFT_RUN dispenses all missed the prediction by more than
+  DRIFT_TOLERANCE (and more than the fit's own uncertainty allows) in the
+  same direction, i.e. the pump changes faster than the fit follows. The fit
+  then forgets its confidence so the next dispenses re-fit it quickly;
+* nonlinearity: the fitted rate differs by more than NONLINEAR_TOLERANCE
+  across the feedrates seen, so one constant per pump is not enough.
+
+Reopening the file replays the history, so the estimate survives restarts.
+
+    calibration = PumpCalibration('pump_calibration_COM5.jsonl')
+    steps_per_g = calibration.steps_per_g('X', 2000, nominal=-1345)
+    calibration.record('X', -2690, 2000, 1.97)
+    print(calibration.report())
+"""
+import json
+import math
+import os
+import threading
+import time
+
+FORGETTING          = 0.97   # per dispense; ~30 dispenses of memory
+NOISE_G             = 0.01   # g, scale noise on one measured dispense
+PRIOR_RATE_SPREAD   = 0.3    # relative uncertainty of the nominal constant
+PRIOR_FEED_SPREAD   = 0.05   # relative rate change per 1000 mm/min assumed possible
+MIN_RECORDS         = 3      # before the fit is trusted over the nominal constant
+TRUST_SPREAD        = 0.03   # relative 1-sigma rate uncertainty the fit must be within
+DRIFT_TOLERANCE     = 0.03
+DRIFT_RUN           = 3
+DRIFT_SIGMA         = 2.0    # a miss must also be this many predicted sigmas
+NONLINEAR_TOLERANCE = 0.05
+
+DEFAULT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class PumpModel:
+    """Recursive least squares fit of one pump's grams per 1000 steps."""
+
+    def __init__(self, nominal_steps_per_g):
+        self.theta = [1000.0 / nominal_steps_per_g, 0.0]
+        self.records = 0
+        self.drifts = 0
+        self.feed_range = None  # (lowest, highest) feedrate recorded
+        self._reset_confidence()  # also clears self.misses, the last DRIFT_RUN relative errors
+
+    @staticmethod
+    def _x(steps, feedrate):
+        k = steps / 1000.0
+        return [k, k * feedrate / 1000.0]
+
+    def grams_per_step(self, feedrate):
+        return (self.theta[0] + self.theta[1] * feedrate / 1000.0) / 1000.0
+
+    def steps_per_g(self, feedrate):
+        return 1.0 / self.grams_per_step(feedrate)
+
+    def spread(self, feedrate):
+        """Relative 1-sigma uncertainty of the rate at `feedrate`."""
+        f = feedrate / 1000.0
+        P = self.P
+        var = P[0][0] + 2 * f * P[0][1] + f * f * P[1][1]
+        return math.sqrt(max(var, 0.0)) / abs(self.theta[0] + self.theta[1] * f)
+
+    def update(self, steps, feedrate, grams):
+        """Fold in one dispense; returns the relative error of the prediction made before it."""
+        x = self._x(steps, feedrate)
+        P, theta = self.P, self.theta
+        Px = [P[0][0] * x[0] + P[0][1] * x[1], P[1][0] * x[0] + P[1][1] * x[1]]
+        predicted = theta[0] * x[0] + theta[1] * x[1]
+        innovation = grams - predicted
+        expected = NOISE_G ** 2 + x[0] * Px[0] + x[1] * Px[1]  # variance of the innovation
+        gain_den = FORGETTING * NOISE_G ** 2 + x[0] * Px[0] + x[1] * Px[1]
+        K = [Px[0] / gain_den, Px[1] / gain_den]
+        theta[0] += K[0] * innovation
+        theta[1] += K[1] * innovation
+        self.P = [[(P[i][j] - K[i] * Px[j]) / FORGETTING for j in range(2)] for i in range(2)]
+
+        self.records += 1
+        lo, hi = self.feed_range or (feedrate, feedrate)
+        self.feed_range = (min(lo, feedrate), max(hi, feedrate))
+        miss = innovation / predicted if predicted else 0.0
+        significant = abs(innovation) > DRIFT_SIGMA * math.sqrt(expected)
+        self.misses = (self.misses + [miss if significant else 0.0])[-DRIFT_RUN:]
+        return miss
+
+    def _reset_confidence(self):
+        rate = self.theta[0]
+        self.P = [[(PRIOR_RATE_SPREAD * rate) ** 2, 0.0],
+                  [0.0, (PRIOR_FEED_SPREAD * rate) ** 2]]
+        self.misses = []
+
+    @property
+    def drifting(self):
+        misses = self.misses
+        return (len(misses) == DRIFT_RUN
+                and (all(m > DRIFT_TOLERANCE for m in misses) or all(m < -DRIFT_TOLERANCE for m in misses)))
+
+    @property
+    def nonlinearity(self):
+        """Relative rate difference across the recorded feedrates (0 with one feedrate)."""
+        if self.feed_range is None:
+            return 0.0
+        lo, hi = self.feed_range
+        return abs(self.grams_per_step(hi) - self.grams_per_step(lo)) / abs(self.grams_per_step((lo + hi) / 2))
+
+    def trusted(self, feedrate):
+        return (self.records >= MIN_RECORDS and not self.drifting
+                and self.spread(feedrate) <= TRUST_SPREAD)
+
+
+class PumpCalibration:
+    """Append-only dispense history and a PumpModel per pump, shared by threads."""
+
+    def __init__(self, path):
+        self.path = path
+        self.models = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._fold(entry['pump'], entry['steps'], entry['feedrate'], entry['grams'],
+                                   entry['nominal'])
+
+    @classmethod
+    def for_station(cls, name, directory=DEFAULT_DIR):
+        """The history file of one station (e.g. its scale port)."""
+        return cls(os.path.join(directory, f"pump_calibration_{os.path.basename(name)}.jsonl"))
+
+    def _fold(self, pump, steps, feedrate, grams, nominal):
+        model = self.models.get(pump)
+        if model is None:
+            model = self.models[pump] = PumpModel(nominal)
+        model.update(steps, feedrate, grams)
+        drifted = model.drifting
+        if drifted:
+            model.drifts += 1
+            model._reset_confidence()
+        return model, drifted
+
+    def record(self, pump, steps, feedrate, grams, nominal=None, timestamp=None):
+        """Log one dispense of `steps` at `feedrate` that moved `grams` and refit.
+        `nominal` (steps per gram) seeds a pump seen for the first time."""
+        with self._lock:
+            if nominal is None:
+                if pump not in self.models:
+                    raise ValueError(f"No nominal constant for new pump {pump}")
+                nominal = self.models[pump].steps_per_g(feedrate)
+            entry = {'time': time.time() if timestamp is None else timestamp, 'pump': pump,
+                     'steps': steps, 'feedrate': feedrate, 'grams': round(grams, 5),
+                     'nominal': nominal}
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + "\n")
+            before = self.models[pump].nonlinearity if pump in self.models else 0.0
+            model, drifted = self._fold(pump, steps, feedrate, grams, nominal)
+            if drifted:
+                print(f"[WARN] pump {pump} is drifting, now {model.steps_per_g(feedrate):.1f} steps/g "
+                      f"at F{feedrate:g}; refitting")
+            if model.nonlinearity > NONLINEAR_TOLERANCE >= before:
+                lo, hi = model.feed_range
+                print(f"[WARN] pump {pump}: rate differs {model.nonlinearity:.1%} between F{lo:g} and F{hi:g}")
+            return model
+
+    def steps_per_g(self, pump, feedrate, nominal):
+        """Live estimate for `pump` at `feedrate`, or `nominal` until the fit is trusted."""
+        with self._lock:
+            model = self.models.get(pump)
+            if model is None or not model.trusted(feedrate):
+                return nominal
+            return model.steps_per_g(feedrate)
+
+    def trusted(self, pump, feedrate):
+        with self._lock:
+            model = self.models.get(pump)
+            return model is not None and model.trusted(feedrate)
+
+    def report(self):
+        """{pump: summary} of every fitted pump."""
+        with self._lock:
+            out = {}
+            for pump, model in self.models.items():
+                lo, hi = model.feed_range
+                out[pump] = {'records': model.records,
+                             'steps_per_g': {f: round(model.steps_per_g(f), 1) for f in sorted({lo, hi})},
+                             'spread': round(model.spread(lo), 4),
+                             'nonlinearity': round(model.nonlinearity, 4),
+                             'drifts': model.drifts}
+            return out
+
+
+if __name__ == "__main__":
+    import sys
+    for pump, summary in PumpCalibration(sys.argv[1]).report().items():
+        print(pump, summary)
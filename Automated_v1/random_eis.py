@@ -3,10 +3,8 @@
 
 import time
 import random
-from statistics import mean
 
-from motorcontroller import MotorController
-from scale_reader   import open_scale, read_weight
+import connections
 from eis_module     import main as run_eis  # Uncomment if EIS module is needed
 
 # —— Configurable Parameters —— #
@@ -55,33 +53,10 @@ def steps_to_volume(steps, per_ml):
 def wait_for_stable_weight(window=3, threshold=0.001, timeout=6):
     """
     Read the electronic scale until a stable weight is reached.
-    Uses non-blocking serial read for fast convergence.
+    Queries the shared scale stream, so no port is opened per call.
     """
-    import collections
-    weights = collections.deque(maxlen=window)
-    start_time = time.time()
-    ser = open_scale(port=PORT_SCALE, timeout=0.05)
-
-    try:
-        while True:
-            if ser.in_waiting:
-                try:
-                    w = read_weight(ser)
-                    weights.append(w)
-                    if len(weights) == window:
-                        delta = max(weights) - min(weights)
-                        if delta < threshold:
-                            return mean(weights)
-                except Exception as e:
-                    print(f"[Warning] read failed: {e}")
-            if time.time() - start_time > timeout:
-                print()
-                return mean(weights) if weights else 0.0
-            time.sleep(0.05)
-    except KeyboardInterrupt:
-        print("\nInterrupted by user.")
-    finally:
-        ser.close()
+    weight = connections.scale_stream(PORT_SCALE).wait_stable(window, threshold, timeout)
+    return 0.0 if weight is None else weight
 
 def run_wash_cycle(motor):
     """
@@ -111,7 +86,7 @@ def run_wash_cycle(motor):
     #Z2 = run_eis()
 
 def automated_pipeline():
-    motor = MotorController(port=PORT_MOTOR)
+    motor = connections.motor(PORT_MOTOR)
     total_cycles = 20
 
     print(f">>> Prefilling system with water...")
@@ -185,7 +160,6 @@ def automated_pipeline():
         print("--------------- All", total_cycles, "cycles complete! ---------------")
     finally:
         motor.disable_steppers()
-        motor.close()
 
 if __name__ == "__main__":
     automated_pipeline()
\ No newline at end of file
@@ -2,7 +2,29 @@
 
 import serial
 import time
-import re  # 导入正则表达式模块
+import weakref
+
+from line_framer import LineFramer, parse_number
+
+# One framer per open port, so bytes after the last complete line are kept
+# for the next read instead of being lost
+_framers = weakref.WeakKeyDictionary()
+
+# How long open_scale() waits for the first reading, and after how long of
+# silence it asks for one (SI: send one weight value, for request-mode balances)
+READY_TIMEOUT = 3.0
+PING_AFTER = 0.3
+
+# Request-mode balances are polled with SI (the current weight at once, stable
+# or not). POLL_DEPTH requests are kept in flight, so the next reply is already
+# on the line while the host parses the current one.
+POLL_COMMAND = b"SI\r\n"
+POLL_DEPTH = 2
+
+# 'continuous' or 'request' per open port, as found by detect_mode()
+_modes = weakref.WeakKeyDictionary()
+# Polls sent and not answered yet, per port
+_in_flight = weakref.WeakKeyDictionary()
 
 def open_scale(port='COM5',
                baudrate=9600,
@@ -19,31 +41,97 @@ def open_scale(port='COM5',
             stopbits=serial.STOPBITS_ONE,
             timeout=timeout
         )
-        # Give the scale time to initialize/reset
-        time.sleep(2)
-        print(f"Reading......")
+        # Ready as soon as the first reading arrives, not after a fixed delay
+        mode = detect_mode(ser)
+        if mode is None:
+            print(f"[WARN] no reading from {port} after {READY_TIMEOUT:g} s")
+        print(f"Reading ({mode or 'unknown'} mode)......")
         return ser
     except serial.SerialException as e:
         print(f"Error opening {port}: {e}")
         raise
 
+def _framer(ser):
+    framer = _framers.get(ser)
+    if framer is None:
+        framer = _framers[ser] = LineFramer(256)
+    return framer
+
+def detect_mode(ser, timeout=READY_TIMEOUT):
+    """
+    Wait for the first valid weight from a freshly opened scale and note how
+    it came: 'continuous' if the scale sent it by itself, 'request' if it only
+    answered the SI sent after PING_AFTER s of silence. Returns the mode, or
+    None if nothing arrived within `timeout` s. A continuous balance slower
+    than PING_AFTER may be taken for a request-mode one; polling it works too.
+    """
+    framer = _framer(ser)
+    start = time.monotonic()
+    pinged = False
+    while time.monotonic() - start < timeout:
+        for line in framer.read_lines(ser, block=False):
+            try:
+                parse_weight(line)
+            except ValueError:
+                continue  # boot banner or partial line
+            mode = _modes[ser] = 'request' if pinged else 'continuous'
+            return mode
+        if not pinged and time.monotonic() - start > PING_AFTER:
+            ser.write(POLL_COMMAND)
+            pinged = True
+        time.sleep(0.01)
+    return None
+
+def scale_mode(ser):
+    """'continuous', 'request', or None if detect_mode() has not found out."""
+    return _modes.get(ser)
+
+def parse_weight(line):
+    """
+    Extract the first number in one line of scale output (bytes, memoryview
+    or str) and return it as a float in grams.
+    """
+    if isinstance(line, str):
+        line = line.encode('latin-1', errors='replace')
+    try:
+        return parse_number(line)
+    except ValueError:
+        raise ValueError(f"Cannot parse weight from '{bytes(line).decode('latin-1')}'") from None
+
 def read_weight(ser):
     """
     Read one line of ASCII data from the scale serial port,
     extract the first number it contains, and return it as a float in grams.
+    A balance in request mode is polled for it (see poll_weight).
     """
-    raw = ser.readline()
-    try:
-        line = raw.decode('ascii').strip()
-    except UnicodeDecodeError:
-        line = raw.decode('latin-1', errors='replace').strip()
-
-    # 正则表达式提取第一个浮点数（包含可选的正负号）
-    match = re.search(r"[-+]?\d*\.\d+|\d+", line)
-    if match:
-        return float(match.group(0))
+    if _modes.get(ser) == 'request':
+        return poll_weight(ser)
+    line = _framer(ser).next_line(ser)
+    if line is None:
+        # Port timeout with no complete line
+        raise ValueError("Cannot parse weight from ''")
+    return parse_weight(line)
 
-    raise ValueError(f"Cannot parse weight from '{line}'")
+def poll_weight(ser, depth=POLL_DEPTH):
+    """
+    Ask the balance for its weight and return the next reply. Up to `depth`
+    requests are kept outstanding, and the request that replaces an answered
+    one is written before the reply is parsed, so the balance never waits on
+    the host. ValueError on a timeout or a reply that is not a weight.
+    """
+    framer = _framer(ser)
+    in_flight = _in_flight.get(ser, 0)
+    if in_flight < depth:
+        ser.write(POLL_COMMAND * (depth - in_flight))
+        in_flight = depth
+    line = framer.next_line(ser)
+    if line is None:
+        # Requests or replies lost: start over with a fresh set
+        _in_flight[ser] = 0
+        raise ValueError("Cannot parse weight from ''")
+    ser.write(POLL_COMMAND)
+    _in_flight[ser] = in_flight
+    return parse_weight(line)
 
 def main():
     """
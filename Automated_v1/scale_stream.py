@@ -0,0 +1,159 @@
+# scale_stream.py
+"""
+Long-lived scale reader that keeps the recent readings in memory.
+
+A background thread reads the balance with scale_reader.read_weight (which
+polls a balance in request mode) and appends every reading, stamped with
+time.monotonic(), to a fixed-size NumPy ring buffer. Queries only look at the
+buffer, so any stage can ask for the current weight, the last few seconds or
+a stability check at once, without opening the port or draining it.
+
+    stream = connections.scale_stream('COM5')
+    t, w = stream.latest()
+    times, weights = stream.window(2.0)     # readings of the last 2 s
+    w = stream.wait_stable(window=3, threshold=0.001, timeout=6)
+"""
+import threading
+import time
+
+import numpy as np
+import serial
+
+from scale_reader import read_weight
+
+CAPACITY    = 72000  # readings kept: an hour at 20 Hz
+RETRY_DELAY = 0.5    # s before trying the port again after it failed
+
+
+class ScaleStream:
+    """Background reader of one shared scale connection (connections.scale)."""
+
+    def __init__(self, connection, capacity=CAPACITY):
+        self.connection = connection
+        self._times = np.zeros(capacity)
+        self._weights = np.zeros(capacity)
+        self._count = 0  # readings appended so far; the next goes to slot _count % capacity
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self.errors = 0
+        self._subscribers = []
+        self._thread = threading.Thread(target=self._run, name=f"stream-{connection.name}", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                # The port lock is held per reading only, other users can still get in
+                with self.connection as ser:
+                    weight = read_weight(ser)
+            except ValueError:
+                continue  # port timeout, or a line that is not a weight
+            except serial.SerialException as e:
+                self.errors += 1
+                print(f"[WARN] {self.connection.name}: {e}, retrying...")
+                self._stop.wait(RETRY_DELAY)
+                continue
+            t = time.monotonic()
+            self._append(t, weight)
+            for callback in list(self._subscribers):
+                try:
+                    callback(t, weight)
+                except Exception as e:
+                    print(f"[WARN] scale subscriber failed: {e}")
+
+    def _append(self, t, weight):
+        with self._cond:
+            slot = self._count % len(self._times)
+            self._times[slot] = t
+            self._weights[slot] = weight
+            self._count += 1
+            self._cond.notify_all()
+
+    def _since(self, start):
+        """(times, weights) copies of the readings after `start`, oldest first.
+        The caller holds the lock."""
+        capacity = len(self._times)
+        end = self._count % capacity
+        # Oldest first: the wrapped tail of the array, then its head
+        segments = [(end, capacity), (0, end)] if self._count > capacity else [(0, self._count)]
+        times, weights = [], []
+        for lo, hi in segments:
+            first = lo + int(np.searchsorted(self._times[lo:hi], start, side='right'))
+            times.append(self._times[first:hi])
+            weights.append(self._weights[first:hi])
+        return np.concatenate(times), np.concatenate(weights)
+
+    def subscribe(self, callback):
+        """Call `callback(time, weight)` from the reader thread for every new reading.
+        Callbacks must be quick: the next reading waits for them."""
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self._subscribers.remove(callback)
+
+    def __len__(self):
+        """Readings received since the stream started."""
+        return self._count
+
+    def alive(self):
+        return self._thread.is_alive()
+
+    def latest(self):
+        """(time, weight) of the newest reading, or None before the first one."""
+        with self._cond:
+            if not self._count:
+                return None
+            slot = (self._count - 1) % len(self._times)
+            return float(self._times[slot]), float(self._weights[slot])
+
+    def since(self, start):
+        """(times, weights) arrays of the readings taken after monotonic time `start`."""
+        with self._cond:
+            return self._since(start)
+
+    def window(self, seconds):
+        """(times, weights) arrays of the readings of the last `seconds`."""
+        return self.since(time.monotonic() - seconds)
+
+    def rate(self, seconds=5.0):
+        """Readings per second over the last `seconds`."""
+        times = self.window(seconds)[0]
+        return (len(times) - 1) / (times[-1] - times[0]) if len(times) > 1 and times[-1] > times[0] else 0.0
+
+    def wait_reading(self, after=None, timeout=1.0):
+        """Wait for a reading taken after `after` (default: now); returns (time,
+        weight), or None after `timeout` s."""
+        after = time.monotonic() if after is None else after
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                newest = self.latest()
+                if newest is not None and newest[0] > after:
+                    return newest
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+    def wait_stable(self, window=3, threshold=0.001, timeout=6):
+        """
+        Wait until the last `window` readings taken after the call agree within
+        `threshold` g and return their mean. After `timeout` s, return the mean
+        of the last readings that did arrive, or None if there were none.
+        """
+        start = time.monotonic()
+        deadline = start + timeout
+        with self._cond:
+            while True:
+                weights = self._since(start)[1][-window:]
+                if len(weights) == window and weights.max() - weights.min() < threshold:
+                    return float(weights.mean())
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return float(weights.mean()) if len(weights) else None
+                self._cond.wait(remaining)
+
+    def close(self):
+        """Stop the reader thread; the port itself stays with its connection."""
+        self._stop.set()
+        self._thread.join(timeout=2)
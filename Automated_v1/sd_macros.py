@@ -0,0 +1,169 @@
+# sd_macros.py
+"""
+Run fixed protocol sequences from the board's SD card.
+
+A sequence of G-code lines (for example the wash loop) is compiled into a
+.gcode file named after its content hash, uploaded once with Marlin's binary
+file transfer, and started with M23/M24. The board then runs every move with
+no serial round trips; the host only polls progress (M27). Uploading the same
+sequence again is skipped because the file is already on the card.
+
+Needs firmware built with SDSUPPORT and BINARY_FILE_TRANSFER, and
+MarlinBinaryProtocol.py (Octopus-main/.../buildroot/share/scripts).
+
+    run = sd_macros.run_macro(motor, ["G91", "T3", "G1 E-20 F1000", "T1", "G1 E600 F2000"])
+    run.wait()
+"""
+import hashlib
+import os
+import re
+import sys
+import tempfile
+import time
+from collections import deque
+
+_SCRIPTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Octopus-main', 'Octopus-main',
+                        'buildroot', 'share', 'scripts')
+if os.path.isdir(_SCRIPTS) and _SCRIPTS not in sys.path:
+    sys.path.append(_SCRIPTS)
+
+try:
+    import MarlinBinaryProtocol
+except ImportError:
+    MarlinBinaryProtocol = None
+
+# Payload bytes per binary transfer packet (the board may ask for less)
+BLOCK_SIZE = 512
+
+# 'SD printing byte 1234/5678'
+_SD_PROGRESS = re.compile(r"SD printing byte (\d+)/(\d+)")
+
+# Files known to be on the card, per port, so the M20 listing is read once
+_on_card = {}
+
+
+def compile_macro(lines):
+    """Return (8.3 file name, file text) for a sequence of G-code lines.
+    The name is derived from the content, so identical sequences share a file."""
+    body = "\n".join(line.strip() for line in lines if line.strip()) + "\nM400\n"
+    digest = hashlib.sha1(body.encode()).hexdigest()
+    text = f"; protocol macro {digest}\n" + body
+    return f"{digest[:8].upper()}.GCO", text
+
+
+def list_sd_files(controller, refresh=False):
+    """Names of the files in the card's root (M20), cached per port."""
+    port = controller.ser.port
+    if refresh or port not in _on_card:
+        files = set()
+        listing = False
+        for line in controller.send_gcode("M20"):
+            if line.startswith("Begin file list"):
+                listing = True
+            elif line.startswith("End file list"):
+                listing = False
+            elif listing and line.strip():
+                files.add(line.split()[0].upper())
+        _on_card[port] = files
+    return _on_card[port]
+
+
+def upload_macro(controller, name, text):
+    """Copy `text` to the SD card as `name` with the binary file transfer.
+
+    The transfer opens the port itself, so the controller's port is closed
+    for the duration (its reader thread just waits) and opened again after.
+    """
+    if MarlinBinaryProtocol is None:
+        raise RuntimeError("MarlinBinaryProtocol.py not found; cannot upload to the SD card")
+    controller.wait_for_motion()
+    controller.drain()
+
+    fd, path = tempfile.mkstemp(suffix=".gcode")
+    with os.fdopen(fd, "w") as f:
+        f.write(text)
+    ser = controller.ser
+    # Hold the controller lock so no thread writes to the port mid-transfer
+    with controller._cond:
+        ser.close()
+        try:
+            # The protocol classes keep their handlers and replies at class level;
+            # start each session clean
+            MarlinBinaryProtocol.Protocol.applications = []
+            MarlinBinaryProtocol.Protocol.responses = deque()
+            MarlinBinaryProtocol.FileTransferProtocol.responses = deque()
+            protocol = MarlinBinaryProtocol.Protocol(ser.port, ser.baudrate, BLOCK_SIZE, 0, 1000)
+            try:
+                protocol.connect()
+                transfer = MarlinBinaryProtocol.FileTransferProtocol(protocol)
+                ok = transfer.copy(path, name, False, False)
+                protocol.disconnect()
+            finally:
+                protocol.shutdown()
+        finally:
+            os.remove(path)
+            ser.open()
+    if not ok:
+        raise IOError(f"Upload of {name} to the SD card failed")
+    _on_card.setdefault(ser.port, set()).add(name)
+
+
+class MacroRun:
+    """Progress handle for a macro the board is running from the SD card.
+    Once it has finished, the controller's position and motion prediction are
+    read back from the board (resync_position), since the macro moved the
+    axes behind its back."""
+
+    def __init__(self, controller, name):
+        self.controller = controller
+        self.name = name
+        self.finished = False
+
+    def progress(self):
+        """Fraction of the file executed so far (M27); 1.0 once finished."""
+        if self.finished:
+            return 1.0
+        for line in self.controller.send_gcode("M27"):
+            match = _SD_PROGRESS.search(line)
+            if match:
+                done, total = int(match.group(1)), int(match.group(2))
+                if total and done >= total:
+                    break
+                return done / total if total else 0.0
+            if "Not SD printing" in line:
+                break
+        else:
+            return 0.0
+        # The file ends with M400, which resync_position() waits for as well
+        self.controller.resync_position()
+        self.finished = True
+        return 1.0
+
+    def done(self):
+        return self.progress() >= 1.0
+
+    def wait(self, poll=1.0, timeout=None):
+        """Block until the board has run the whole file (the file ends with M400)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.done():
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"{self.name} still running after {timeout} s")
+            time.sleep(poll)
+        return self
+
+
+def run_macro(controller, lines, wait=False):
+    """Compile `lines`, upload them unless the card already has them, and start
+    the file. Returns a MacroRun."""
+    name, text = compile_macro(lines)
+    if name not in list_sd_files(controller):
+        print(f">>> Uploading protocol macro {name} ({len(text)} bytes)")
+        upload_macro(controller, name, text)
+    controller.send_gcode(f"M23 {name}")
+    controller.send_gcode("M24")
+    # The file changes positioning mode and tool behind the controller's back
+    controller._modal.clear()
+    run = MacroRun(controller, name)
+    if wait:
+        run.wait()
+    return run
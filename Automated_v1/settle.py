@@ -0,0 +1,168 @@
+# settle.py
+"""
+Decide from the scale stream when the mass has stopped changing.
+
+Instead of sleeping a fixed time after a pump stops and then asking for three
+readings within 0.001 g, wait_settled() tests the readings as they arrive and
+returns as soon as the mass is statistically flat:
+
+* slope: a straight line fitted over the last WINDOW_SECONDS must have a
+  slope whose upper confidence bound is below SLOPE_LIMIT (no drip, no
+  evaporation trend worth waiting for);
+* variance: the scatter around that line must be below MAX_STD (no sloshing
+  or air draught).
+
+The weight is the window mean with a confidence half-width, so callers can
+see how good a reading is. With kalman=True a constant-velocity Kalman filter
+is run over the stream instead, which reacts faster on slow balances; the
+filtered flow rate then takes the place of the fitted slope.
+
+    s = wait_settled(connections.scale_stream('COM5'))
+    print(f"{s.weight:.4f} ± {s.ci:.4f} g after {s.elapsed:.1f} s")
+"""
+import math
+import time
+
+import numpy as np
+
+WINDOW_SECONDS = 2.0     # readings the tests look at...
+MIN_READINGS   = 8       # ...but never fewer than this many
+SLOPE_LIMIT    = 0.0005  # g/s still counted as flat
+MAX_STD        = 0.002   # g of scatter around the fitted line
+CONFIDENCE_Z   = 2.0     # ~95 % bounds
+SETTLE_TIMEOUT = 60.0    # s, the longest the old fixed sleeps took
+
+# Kalman filter: scale noise and how fast the flow may change (g/s per sqrt(s))
+KALMAN_NOISE = 0.0005
+KALMAN_ACCEL = 0.0001
+KALMAN_RESTART = 4.0  # a reading this many sigmas off restarts the filter (mass still moving)
+
+
+class Settle:
+    """Outcome of wait_settled()."""
+
+    def __init__(self, weight, ci, slope, readings, elapsed, settled):
+        self.weight = weight      # g
+        self.ci = ci              # g, half-width of the CONFIDENCE_Z interval
+        self.slope = slope        # g/s at the end
+        self.readings = readings  # used by the final test
+        self.elapsed = elapsed    # s waited
+        self.settled = settled    # False if the timeout ran out first
+
+    def __repr__(self):
+        state = "settled" if self.settled else "NOT settled"
+        return f"Settle({self.weight:.4f} ± {self.ci:.4f} g, {self.slope * 1000:+.2f} mg/s, {state} in {self.elapsed:.1f} s)"
+
+
+def flat_test(times, weights):
+    """Slope and variance test of one window of readings.
+    Returns (flat, weight, ci, slope); None if there are too few readings."""
+    n = len(weights)
+    if n < 3:
+        return None
+    t = times - times.mean()
+    sxx = float(t @ t)
+    if sxx <= 0.0:
+        return None
+    mean = float(weights.mean())
+    slope = float(t @ (weights - mean)) / sxx
+    residuals = weights - mean - slope * t
+    std = math.sqrt(float(residuals @ residuals) / (n - 2))
+    slope_se = std / math.sqrt(sxx)
+    ci = CONFIDENCE_Z * std / math.sqrt(n)
+    flat = abs(slope) + CONFIDENCE_Z * slope_se < SLOPE_LIMIT and std < MAX_STD
+    return flat, mean, ci, slope
+
+
+class MassKalman:
+    """Constant-velocity Kalman filter of (mass, flow) over timestamped readings."""
+
+    def __init__(self, noise=KALMAN_NOISE, accel=KALMAN_ACCEL):
+        self.r = noise ** 2
+        self.q = accel ** 2
+        self.x = None  # [mass, flow]
+        self.P = None
+        self.t = None
+        self.updates = 0
+
+    def _restart(self, t, weight):
+        self.x = [weight, 0.0]
+        self.P = [[self.r, 0.0], [0.0, SLOPE_LIMIT ** 2 * 100]]
+        self.t = t
+        self.updates = 1
+
+    def update(self, t, weight):
+        if self.x is None:
+            self._restart(t, weight)
+            return
+        dt = t - self.t
+        self.t = t
+        (p00, p01), (_, p11) = self.P
+        # Predict
+        m, v = self.x[0] + dt * self.x[1], self.x[1]
+        p00 = p00 + 2 * dt * p01 + dt * dt * p11 + self.q * dt ** 3 / 3
+        p01 = p01 + dt * p11 + self.q * dt ** 2 / 2
+        p11 = p11 + self.q * dt
+        # Correct with the reading
+        s = p00 + self.r
+        innovation = weight - m
+        if innovation * innovation > KALMAN_RESTART ** 2 * s:
+            # A slow flow model cannot follow this: start over from here
+            self._restart(t, weight)
+            return
+        k0, k1 = p00 / s, p01 / s
+        self.x = [m + k0 * innovation, v + k1 * innovation]
+        self.P = [[(1 - k0) * p00, (1 - k0) * p01], [(1 - k0) * p01, p11 - k1 * p01]]
+        self.updates += 1
+
+    def state(self):
+        """(flat, weight, ci, flow) like flat_test()."""
+        (p00, _), (_, p11) = self.P
+        weight, flow = self.x
+        flat = (self.updates >= MIN_READINGS
+                and abs(flow) + CONFIDENCE_Z * math.sqrt(p11) < SLOPE_LIMIT)
+        return flat, weight, CONFIDENCE_Z * math.sqrt(p00), flow
+
+
+def wait_settled(stream, timeout=SETTLE_TIMEOUT, kalman=False, quiet=False):
+    """
+    Wait on a ScaleStream until the mass is flat (see the module docstring),
+    using only readings taken after the call. Returns a Settle; after
+    `timeout` s it holds the latest estimate with settled=False.
+    """
+    start = last = time.monotonic()
+    filt = MassKalman() if kalman else None
+    result, readings = None, 0
+    while True:
+        remaining = start + timeout - time.monotonic()
+        if remaining <= 0:
+            break
+        if stream.wait_reading(after=last, timeout=remaining) is None:
+            continue
+        if filt is not None:
+            times, weights = stream.since(last)
+            for t, w in zip(times, weights):
+                filt.update(t, w)
+            result, readings = filt.state(), filt.updates
+        else:
+            times, weights = stream.since(start)
+            if len(weights) < MIN_READINGS:
+                last = times[-1]
+                continue
+            readings = max(MIN_READINGS, int(np.count_nonzero(times > times[-1] - WINDOW_SECONDS)))
+            result = flat_test(times[-readings:], weights[-readings:])
+        last = times[-1]
+        if result is not None and result[0]:
+            _, weight, ci, slope = result
+            return Settle(weight, ci, slope, readings, time.monotonic() - start, True)
+
+    elapsed = time.monotonic() - start
+    if result is None:
+        newest = stream.latest()
+        if newest is None:
+            raise RuntimeError("No reading from the scale")
+        return Settle(newest[1], float('inf'), 0.0, 0, elapsed, False)
+    _, weight, ci, slope = result
+    if not quiet:
+        print(f"[WARN] scale not settled after {timeout:g} s ({slope * 1000:+.2f} mg/s), using {weight:.4f} g")
+    return Settle(weight, ci, slope, readings, elapsed, False)
@@ -0,0 +1,250 @@
+# telemetry.py
+"""
+Append-only columnar log of scale readings, issued G-code and position reports.
+
+Each table is a directory of fixed-size NumPy .npy segments, written through a
+memory map: a row goes straight into the open segment, so a writer never holds
+more than the mapped pages however long it runs, and nothing is rewritten.
+index.json lists every segment with its row count, time span and run ids. A
+query opens only the segments that overlap, maps them read-only and cuts the
+rows out with a binary search on the time column.
+
+Tables (time is Unix time in seconds, run the id from start_run(), 0 outside
+a run):
+
+    scale     time, run, weight
+    gcode     time, run, line      (first LINE_WIDTH bytes of the command)
+    position  time, run, X, Y, Z, E
+
+    log = TelemetryLog.for_station('COM5')
+    log.attach(motor=motor, stream=connections.scale_stream('COM5'))
+    run = log.start_run("20/4/20.5")
+    ...
+    weights = log.query('scale', run=run)                  # structured array
+    last_hour = log.query('position', start=time.time() - 3600)
+"""
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from line_framer import parse_axes
+
+SEGMENT_ROWS  = 1 << 18  # rows per segment file (~5 MB of scale readings)
+FLUSH_SECONDS = 5.0      # how stale index.json may get while rows arrive
+LINE_WIDTH    = 72       # bytes of a G-code line that are kept
+
+POSITION_AXES = ('X', 'Y', 'Z', 'E')
+TABLES = {
+    'scale':    np.dtype([('time', 'f8'), ('run', 'i4'), ('weight', 'f8')]),
+    'gcode':    np.dtype([('time', 'f8'), ('run', 'i4'), ('line', f'S{LINE_WIDTH}')]),
+    'position': np.dtype([('time', 'f8'), ('run', 'i4')] + [(axis, 'f8') for axis in POSITION_AXES]),
+}
+
+DEFAULT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'telemetry')
+
+
+def _write_json(path, data):
+    # Write-then-rename, so a crash never leaves half an index behind
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+class _Table:
+    """One table's segments; append() and query() may run on different threads."""
+
+    def __init__(self, directory, dtype):
+        self.directory = directory
+        self.dtype = dtype
+        os.makedirs(directory, exist_ok=True)
+        self._index_path = os.path.join(directory, 'index.json')
+        self.segments = []
+        if os.path.exists(self._index_path):
+            with open(self._index_path) as f:
+                self.segments = json.load(f)
+        # A segment started after the index was last saved (the process died)
+        indexed = {segment['file'] for segment in self.segments}
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.npy') and name not in indexed:
+                self.segments.append({'file': name, 'rows': 0, 't0': None, 't1': None, 'runs': None})
+        self._map = None
+        self._rows = 0
+        self._saved = time.monotonic()
+        self._lock = threading.Lock()
+        if self.segments and self.segments[-1]['rows'] < SEGMENT_ROWS:
+            self._reopen_last()
+
+    def _reopen_last(self):
+        """Carry on in the last segment, counting rows written after the index
+        was last saved (rows are filled in order and unused ones have time 0)."""
+        segment = self.segments[-1]
+        self._map = np.load(os.path.join(self.directory, segment['file']), mmap_mode='r+')
+        times = self._map['time']
+        self._rows = int(np.count_nonzero(times))
+        if self._rows > segment['rows']:
+            segment['rows'] = self._rows
+            segment['t0'] = float(times[0])
+            segment['t1'] = float(times[self._rows - 1])
+            runs = self._map['run'][:self._rows]
+            segment['runs'] = [int(runs.min()), int(runs.max())]
+
+    def _roll(self):
+        if self._map is not None:
+            self._map.flush()
+        name = f"{len(self.segments):06d}.npy"
+        self._map = np.lib.format.open_memmap(os.path.join(self.directory, name), mode='w+',
+                                              dtype=self.dtype, shape=(SEGMENT_ROWS,))
+        self._rows = 0
+        self.segments.append({'file': name, 'rows': 0, 't0': None, 't1': None, 'runs': None})
+
+    def _save(self):
+        self._map.flush()
+        _write_json(self._index_path, self.segments)
+        self._saved = time.monotonic()
+
+    def append(self, row):
+        with self._lock:
+            if self._map is None or self._rows == SEGMENT_ROWS:
+                self._roll()
+            self._map[self._rows] = row
+            self._rows += 1
+            segment = self.segments[-1]
+            t, run = row[0], row[1]
+            if segment['t0'] is None:
+                segment['t0'], segment['runs'] = t, [run, run]
+            segment['t1'] = t
+            segment['rows'] = self._rows
+            if run < segment['runs'][0] or run > segment['runs'][1]:
+                segment['runs'] = [min(run, segment['runs'][0]), max(run, segment['runs'][1])]
+            if self._rows == SEGMENT_ROWS or time.monotonic() - self._saved > FLUSH_SECONDS:
+                self._save()
+
+    def query(self, start=None, end=None, run=None):
+        with self._lock:
+            segments = [dict(segment) for segment in self.segments if segment['rows']]
+        parts = []
+        for segment in segments:
+            if (start is not None and segment['t1'] < start) or (end is not None and segment['t0'] > end):
+                continue
+            if run is not None and not segment['runs'][0] <= run <= segment['runs'][1]:
+                continue
+            rows = np.load(os.path.join(self.directory, segment['file']), mmap_mode='r')[:segment['rows']]
+            times = rows['time']
+            lo = int(np.searchsorted(times, start, side='left')) if start is not None else 0
+            hi = int(np.searchsorted(times, end, side='right')) if end is not None else len(rows)
+            rows = rows[lo:hi]
+            if run is not None:
+                rows = rows[rows['run'] == run]
+            parts.append(np.array(rows))  # copied out of the map
+        return np.concatenate(parts) if parts else np.empty(0, self.dtype)
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._save()
+                self._map = None
+
+
+class TelemetryLog:
+    """The scale, gcode and position tables of one station, plus its runs."""
+
+    def __init__(self, directory=DEFAULT_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.tables = {name: _Table(os.path.join(directory, name), dtype) for name, dtype in TABLES.items()}
+        self._runs_path = os.path.join(directory, 'runs.json')
+        self._runs = {}
+        if os.path.exists(self._runs_path):
+            with open(self._runs_path) as f:
+                self._runs = {int(run): info for run, info in json.load(f).items()}
+        self.run = 0
+        self._lock = threading.Lock()
+        self._attached = []  # (source, kind or None, callback) to detach on close
+        # Scale readings carry monotonic times; this turns them into Unix time
+        self._clock_offset = time.time() - time.monotonic()
+
+    @classmethod
+    def for_station(cls, name, directory=None):
+        """The log of one station (e.g. by its scale port), next to this file."""
+        return cls(os.path.join(directory or DEFAULT_DIR, os.path.basename(name)))
+
+    def start_run(self, name=""):
+        """Tag everything logged from now on with a new run id (ending the current run)."""
+        with self._lock:
+            now = time.time()
+            if self.run:
+                self._runs[self.run]['end'] = now
+            self.run = max(self._runs, default=0) + 1
+            self._runs[self.run] = {'name': name, 'start': now, 'end': None}
+            _write_json(self._runs_path, self._runs)
+            return self.run
+
+    def end_run(self):
+        with self._lock:
+            if self.run:
+                self._runs[self.run]['end'] = time.time()
+                _write_json(self._runs_path, self._runs)
+                self.run = 0
+
+    def runs(self):
+        """{run id: {'name', 'start', 'end'}} of every run logged here."""
+        with self._lock:
+            return {run: dict(info) for run, info in self._runs.items()}
+
+    def log_scale(self, t, weight):
+        """One reading; `t` is time.monotonic() as stamped by the ScaleStream."""
+        self.tables['scale'].append((t + self._clock_offset, self.run, weight))
+
+    def log_gcode(self, line):
+        self.tables['gcode'].append((time.time(), self.run, line.encode()[:LINE_WIDTH]))
+
+    def log_position(self, line):
+        """A Marlin position report ('X:.. Y:.. Z:.. E:.. Count ...')."""
+        axes = parse_axes(line.encode() if isinstance(line, str) else line)
+        self.tables['position'].append((time.time(), self.run) +
+                                       tuple(axes.get(axis, np.nan) for axis in POSITION_AXES))
+
+    def attach(self, motor=None, stream=None):
+        """Log every command `motor` sends and position it reports, and every
+        reading of the ScaleStream `stream`. Attaching the same source twice is a no-op."""
+        sources = [source for source, _, _ in self._attached]
+        if motor is not None and motor not in sources:
+            motor.subscribe('sent', self.log_gcode)
+            motor.subscribe('position', self.log_position)
+            self._attached += [(motor, 'sent', self.log_gcode), (motor, 'position', self.log_position)]
+        if stream is not None and stream not in sources:
+            stream.subscribe(self.log_scale)
+            self._attached.append((stream, None, self.log_scale))
+
+    def detach(self):
+        for source, kind, callback in self._attached:
+            try:
+                if kind is None:
+                    source.unsubscribe(callback)
+                else:
+                    source.unsubscribe(kind, callback)
+            except ValueError:
+                pass
+        self._attached = []
+
+    def query(self, table, start=None, end=None, run=None):
+        """Rows of `table` with start <= time <= end (Unix time, either may be
+        None) and, if given, of run `run`, oldest first, as a structured array."""
+        if table not in self.tables:
+            raise ValueError(f"Unknown table: {table}. Must be one of: {', '.join(self.tables)}")
+        return self.tables[table].query(start, end, run)
+
+    def close(self):
+        self.detach()
+        self.end_run()
+        for table in self.tables.values():
+            table.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,78 @@
+"""Flow estimates against the virtual balance (virtual_scale) at the rates
+real balances send readings. Needs Linux/macOS for the pseudo-terminal:
+
+    cd Automated_v1 && python -m pytest -q test_flow.py
+"""
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("pty")
+
+import connections  # noqa: E402
+from flow import FlowMonitor, current_flow, wait_finished  # noqa: E402
+from virtual_scale import VirtualScale  # noqa: E402
+
+TIMEOUT = 30.0  # s any one test may take before it counts as hung
+
+
+@pytest.fixture
+def balance():
+    scales = []
+
+    def make(**options):
+        scales.append(VirtualScale(**options))
+        stream = connections.scale_stream(scales[-1].port)
+        assert stream.wait_reading(timeout=2) is not None
+        return scales[-1], stream
+
+    yield make
+    connections.close_all()
+    for s in scales:
+        s.close()
+
+
+def _pour(scale, grams, seconds, steps=50):
+    """Add `grams` to the pan evenly over `seconds`, in the background."""
+    def run():
+        for _ in range(steps):
+            scale.extra += grams / steps
+            time.sleep(seconds / steps)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+@pytest.mark.parametrize("rate", [5.0, 10.0, 20.0])
+def test_current_flow_at_balance_rate(balance, rate):
+    scale, stream = balance(rate=rate, lag=0.1)
+    time.sleep(2.0)
+    assert abs(current_flow(stream)) < 0.01
+    pour = _pour(scale, 1.0, 4.0)  # 0.25 g/s
+    time.sleep(2.5)
+    assert current_flow(stream) == pytest.approx(0.25, abs=0.05)
+    pour.join()
+
+
+@pytest.mark.parametrize("rate", [5.0, 10.0])
+def test_wait_finished_after_a_pour(balance, rate):
+    scale, stream = balance(rate=rate, lag=0.3)
+    time.sleep(1.0)
+    pour = _pour(scale, 0.5, 2.0)
+    time.sleep(0.5)
+    finished = wait_finished(stream, timeout=TIMEOUT, quiet=True)
+    pour.join()
+    assert finished.finished
+    # Not before the pour is over, and not long after the balance caught up
+    assert 1.5 <= finished.elapsed < 6.0
+    assert finished.weight == pytest.approx(scale.true_mass(), abs=0.01)
+
+
+def test_monitor_flags_a_pump_without_flow(balance):
+    scale, stream = balance(rate=5.0)
+    monitor = FlowMonitor(stream, expected=0.2)
+    deadline = time.monotonic() + 10.0
+    while monitor.check() is None and time.monotonic() < deadline:
+        stream.wait_reading(timeout=1.0)
+    assert monitor.fault is not None and "no flow" in monitor.fault
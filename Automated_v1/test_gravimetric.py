@@ -0,0 +1,77 @@
+"""dispense_to_mass() against the virtual board and balance, with a pump
+constant that is off the way a real one is before calibration.
+Needs Linux/macOS for the pseudo-terminal:
+
+    cd Automated_v1 && python -m pytest -q test_gravimetric.py
+"""
+import threading
+
+import pytest
+
+pytest.importorskip("pty")
+
+import connections  # noqa: E402
+from gravimetric import TOLERANCE_G, dispense_to_mass  # noqa: E402
+from motorcontroller import MotorController  # noqa: E402
+from virtual_marlin import VirtualMarlin  # noqa: E402
+from virtual_scale import VirtualScale  # noqa: E402
+
+TIMEOUT = 120.0     # s any one test may take before it counts as hung
+NOMINAL = -1345     # steps per gram the dispense is told
+G_PER_MM = 80 / 1345  # what that constant means for X (80 steps/mm)
+
+
+def _within(fn, timeout=TIMEOUT):
+    """Run `fn` on a daemon thread and return its result; fail if it hangs."""
+    result = {}
+
+    def run():
+        try:
+            result['value'] = fn()
+        except BaseException as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        pytest.fail(f"hung for {timeout:g} s")
+    if 'error' in result:
+        raise result['error']
+    return result.get('value')
+
+
+@pytest.fixture
+def station():
+    """(controller, balance) with the balance's default 0.5 s lag and 10 Hz."""
+    board = VirtualMarlin(extruders=5)
+    scale = VirtualScale(board, {'X': G_PER_MM})
+    motor = MotorController(port=board.port)
+    motor.set_relative_positioning()
+    yield motor, scale
+    motor.close()
+    connections.close_all()
+    scale.close()
+    board.close()
+
+
+@pytest.mark.parametrize("error", [0.37, -0.37])
+def test_wrong_pump_constant_ends_within_tolerance(station, error):
+    motor, scale = station
+    scale.g_per_mm = {'X': G_PER_MM * (1 + error)}
+    result = _within(lambda: dispense_to_mass(motor, 'X', 1.6, NOMINAL, scale_port=scale.port,
+                                              feedrate=2000))
+    assert result.fault is None
+    assert abs(result.error) <= TOLERANCE_G
+    assert abs(scale.true_mass() - result.start_weight - 1.6) <= TOLERANCE_G + 0.005
+    assert result.steps_per_g == pytest.approx(NOMINAL / (1 + error), rel=0.05)
+
+
+def test_tiny_dose_is_not_judged_for_a_clog(station):
+    motor, scale = station
+    scale.g_per_mm = {'X': G_PER_MM * 0.4}
+    # The coarse moves expect under MIN_RECORD_G, too little to call a clog on
+    result = _within(lambda: dispense_to_mass(motor, 'X', 0.06, NOMINAL, scale_port=scale.port,
+                                              feedrate=2000))
+    assert result.fault is None
+    assert abs(result.error) <= TOLERANCE_G
@@ -0,0 +1,74 @@
+"""Regression tests: this station's MotorController (X/Y/Z and pumps
+E0-E4) against the virtual board, on the paths gravimetric dispensing
+takes. Needs Linux/macOS for the pseudo-terminal:
+
+    cd Automated_v1 && python -m pytest -q test_motorcontroller.py
+"""
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("pty")
+
+from motorcontroller import CommandAborted, MotorController  # noqa: E402
+from virtual_marlin import VirtualMarlin  # noqa: E402
+
+TIMEOUT = 30.0  # s any one test may take before it counts as hung
+
+
+def _within(fn, timeout=TIMEOUT):
+    """Run `fn` on a daemon thread and return its result; fail if it hangs."""
+    result = {}
+
+    def run():
+        try:
+            result['value'] = fn()
+        except BaseException as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        pytest.fail(f"hung for {timeout:g} s")
+    if 'error' in result:
+        raise result['error']
+    return result.get('value')
+
+
+@pytest.fixture
+def motor():
+    board = VirtualMarlin(extruders=5)
+    controller = MotorController(port=board.port)
+    controller.set_relative_positioning()
+    yield controller
+    controller.close()
+    board.close()
+
+
+def test_pump_stopped_mid_move(motor):
+    cut = motor.move_motor_by_steps('E0', 20000, 600)  # 40 mm at 10 mm/s
+    time.sleep(0.5)
+    _within(lambda: motor.emergency("M410"))
+    with pytest.raises(CommandAborted):
+        cut.wait(timeout=5)
+    # The stop read the position back (pumps share the E axis): it got part of the way
+    assert 0 < motor.planned_position('E') < 40
+    # The board is idle, and later moves wait normally
+    _within(lambda: motor.wait_for_motion(timeout=5))
+    before = motor.planned_position('E')
+    _within(lambda: motor.move_motor_by_steps('E0', 500, 600).wait(timeout=5))
+    _within(lambda: motor.wait_for_motion(timeout=5))
+    assert motor.planned_position('E') == pytest.approx(before + 1)
+
+
+def test_stops_in_a_row(motor):
+    for _ in range(3):
+        cut = motor.move_motor_by_steps('X', 8000, 1200)
+        time.sleep(0.2)
+        _within(lambda: motor.emergency("M410"))
+        with pytest.raises(CommandAborted):
+            cut.wait(timeout=5)
+        _within(lambda: motor.wait_for_motion(timeout=5))
+    assert len(motor._cut_motion) == 3
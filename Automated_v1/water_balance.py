@@ -1,13 +1,15 @@
-import serial
 import time
 
+import connections
+
 # Adjust port to match your system (e.g. 'COM3' on Windows or '/dev/ttyUSB0' on Linux)
-arduino = serial.Serial('COM6', 9600, timeout=2)
-time.sleep(2)  # Wait for Arduino to initialize
+PORT_PUMP = 'COM6'
 
 def send_command(cmd):
     print(f">> Sending: {cmd}")
-    arduino.write((cmd + '\n').encode())
+    # Opened on first use and kept open (no 2 s Arduino reset per call)
+    with connections.pump(PORT_PUMP) as arduino:
+        arduino.write((cmd + '\n').encode())
     time.sleep(0.1)
 
 def add_water():
@@ -18,5 +20,3 @@ def add_water():
 
     #send_command("CCW")      # Set direction to counterclockwise
     #send_command("STEP2000")  # Move 200 steps
-
-    arduino.close()
\ No newline at end of file
@@ -0,0 +1,296 @@
+"""asyncio version of MotorController.
+
+Every call is awaitable and replies are read by a background task, so one
+event loop can overlap motion with scale reads and EIS acquisition instead of
+blocking on readline(). Plain scripts keep using the blocking MotorController.
+
+    async with AsyncMotorController(port='COM8') as mc:
+        await mc.move_motor_by_steps('I', 8000, 2000)
+
+Uses pyserial-asyncio when it is installed; otherwise the port is read from
+the default executor so the event loop itself never blocks.
+"""
+import asyncio
+from collections import deque
+
+import serial
+
+from motorcontroller import (BOOT_TIMEOUT, DEFAULT_WINDOW, PROBE_INTERVAL, MotorController, _Handshake,
+                             classify_line)
+
+try:
+    import serial_asyncio  # pyserial-asyncio (optional)
+except ImportError:
+    serial_asyncio = None
+
+
+class _StreamLineTransport:
+    """Line transport on top of pyserial-asyncio streams."""
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+
+    async def readline(self):
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("serial port closed")
+        return line
+
+    def write(self, data):
+        self._writer.write(data)
+
+    def close(self):
+        self._writer.close()
+
+
+class _ExecutorLineTransport:
+    """Line transport for a plain serial.Serial: blocking reads run in the executor."""
+
+    def __init__(self, port, baudrate):
+        self.ser = serial.Serial(port, baudrate, timeout=0.1, write_timeout=2)
+        self._buffer = b""
+
+    async def readline(self):
+        loop = asyncio.get_running_loop()
+        while b"\n" not in self._buffer:
+            self._buffer += await loop.run_in_executor(None, self._read_chunk)
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        return line + b"\n"
+
+    def _read_chunk(self):
+        return self.ser.read(self.ser.in_waiting or 1)
+
+    def write(self, data):
+        self.ser.write(data)
+
+    def close(self):
+        self.ser.close()
+
+
+class AsyncMotorController:
+    # Pure helpers shared with the blocking controller
+    steps_to_gcode = MotorController.steps_to_gcode
+    _update_position = MotorController._update_position
+
+    def __init__(self, port='COM8', baudrate=115200, auto_enable=True, window=DEFAULT_WINDOW):
+        self.port = port
+        self.baudrate = baudrate
+        self.auto_enable = auto_enable
+        self.window = max(1, int(window))
+
+        self._transport = None
+        self._reader_task = None
+        self._credits = None
+        # (cmd, response lines, future) for every command awaiting its 'ok'
+        self._inflight = deque()
+        # Why the reader task stopped; every submit after that fails with it
+        self._reader_error = None
+        # Set while connect() waits for the board to answer (see MotorController._await_ready)
+        self._handshake = None
+        self._handshake_event = None
+        self.connect_time = None
+
+        # Track positions for all motors (10 axes: X, Y, Z, I, J, K, U, V, W, E0)
+        self.current_position = {
+            'X': 0, 'Y': 0, 'Z': 0,
+            'I': 0, 'J': 0, 'K': 0,
+            'U': 0, 'V': 0, 'W': 0,
+            'E': 0
+        }
+        # Steps per mm configuration (from Marlin Configuration.h)
+        self.steps_per_mm = {
+            'X': 80, 'Y': 80, 'Z': 80,
+            'I': 80, 'J': 80, 'K': 80,
+            'U': 80, 'V': 80, 'W': 80,
+            'E': 500
+        }
+
+    async def connect(self):
+        if serial_asyncio is not None:
+            reader, writer = await serial_asyncio.open_serial_connection(url=self.port, baudrate=self.baudrate)
+            self._transport = _StreamLineTransport(reader, writer)
+        else:
+            self._transport = _ExecutorLineTransport(self.port, self.baudrate)
+        self._credits = asyncio.Semaphore(self.window)
+        self._reader_error = None
+        self._reader_task = asyncio.create_task(self._read_loop())
+        # Wait for the board to answer rather than a fixed boot time
+        self.connect_time = await self._await_ready()
+        if self.auto_enable:
+            await self.enable_steppers()
+        return self
+
+    async def _await_ready(self, timeout=BOOT_TIMEOUT):
+        """Wait until the board answers M115; returns the seconds it took, or None
+        after warning if it stays silent for `timeout` seconds."""
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        deadline = start + timeout
+        self._handshake = handshake = _Handshake()
+        self._handshake_event = asyncio.Event()
+        try:
+            while True:
+                now = loop.time()
+                if handshake.ready(now):
+                    return now - start
+                if now >= deadline:
+                    print(f"[WARN] no answer from {self.port} after {timeout:g} s; continuing anyway")
+                    return None
+                if handshake.probe_due(now):
+                    self._transport.write(b"M115\r\n")
+                    handshake.probe_sent(now)
+                self._handshake_event.clear()
+                try:
+                    await asyncio.wait_for(self._handshake_event.wait(), min(PROBE_INTERVAL, deadline - now))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._handshake = self._handshake_event = None
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _read_loop(self):
+        try:
+            while True:
+                line = (await self._transport.readline()).decode(errors="ignore").strip()
+                if not line:
+                    continue
+                # print(f"<< {line}")
+                if self._handshake is not None:
+                    # Board still being brought up: lines answer the probes, not commands
+                    self._handshake.on_line(line, classify_line(line))
+                    self._handshake_event.set()
+                    continue
+                pending = self._inflight[0] if self._inflight else None
+                if pending is not None:
+                    pending[1].append(line)
+                if line.startswith("X:"):
+                    self._update_position(line)
+                if line.lower().startswith("ok") and pending is not None:
+                    self._inflight.popleft()
+                    self._credits.release()
+                    if not pending[2].done():
+                        pending[2].set_result(pending[1])
+        except Exception as e:
+            print(f"[WARN] serial reader stopped: {e}")
+            self._reader_error = ConnectionError(f"serial reader stopped: {e}")
+        finally:
+            if self._reader_error is None:
+                self._reader_error = ConnectionError("serial reader stopped")
+            # Nobody will answer the pending commands any more; their credits wake
+            # the submits still waiting, which then fail too (see _submit)
+            while self._inflight:
+                _, _, future = self._inflight.popleft()
+                self._credits.release()
+                if not future.done():
+                    future.set_exception(self._reader_error)
+
+    async def _submit(self, cmd):
+        """Write a command once an 'ok' credit is free; returns a future for its reply."""
+        if self._reader_error is not None:
+            raise self._reader_error
+        await self._credits.acquire()
+        if self._reader_error is not None:
+            self._credits.release()  # pass the wake-up on to the next waiting submit
+            raise self._reader_error
+        future = asyncio.get_running_loop().create_future()
+        # Append and write without yielding so replies stay in command order
+        self._inflight.append((cmd, [], future))
+        # print(f">> {cmd}")
+        self._transport.write((cmd + "\r\n").encode(errors="ignore"))
+        return future
+
+    async def send_gcode(self, cmd):
+        """Send one command and return its response lines once 'ok' arrives."""
+        return await (await self._submit(cmd))
+
+    async def stream_gcode(self, commands):
+        """Send commands back to back, keeping up to `window` in flight.
+        Returns the list of responses, one per command."""
+        futures = [await self._submit(cmd) for cmd in commands]
+        return list(await asyncio.gather(*futures))
+
+    async def wait_for_motion(self):
+        """Wait until every queued move has finished (M400)."""
+        await self.send_gcode("M400")
+
+    async def enable_steppers(self):
+        await self.send_gcode("M17")
+
+    async def disable_steppers(self):
+        await self.send_gcode("M18")
+
+    async def set_absolute_positioning(self):
+        await self.send_gcode("G90")
+
+    async def set_relative_positioning(self):
+        await self.send_gcode("G91")
+
+    async def get_position(self):
+        await self.send_gcode("M114")
+        return self.current_position
+
+    async def move_motor_by_steps(self, motor_name, step_count, feedrate=1000, wait=True):
+        """Move a specified motor by step count.
+        With wait=True the call returns once the move has finished, otherwise as soon
+        as the board has queued it. Positioning mode is shared by all coroutines, so
+        this always re-sends G91 together with the move."""
+        gcode = ["G91"] + self.steps_to_gcode(motor_name, step_count, feedrate)
+        mm = step_count / self.steps_per_mm[motor_name]
+        print(f"\nMoving {motor_name} by {step_count} steps ({mm:.3f} mm)...")
+        await self.stream_gcode(gcode)
+        if wait:
+            await self.wait_for_motion()
+
+    async def home(self, axes=None, wait=True):
+        """Home axes using G28 (see MotorController.home)."""
+        valid = {'X', 'Y', 'Z', 'I', 'J', 'K', 'U', 'V', 'W'}
+        req = [a for a in (axes or []) if a in valid]
+        cmd = "G28 " + " ".join(req) if req else "G28"
+        print(f"\nHoming with: {cmd}")
+        resp = await self.send_gcode(cmd)
+        if wait:
+            await self.wait_for_motion()
+        await self.get_position()
+        return resp
+
+    async def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+            self._reader_task = None
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+
+
+async def main():
+    async with AsyncMotorController() as controller:
+        try:
+            await controller.send_gcode("M211 S0")  # Disable software endstops
+            await controller.set_absolute_positioning()
+
+            # The event loop stays free while the I pump runs; scale reads or EIS
+            # acquisition can run here instead of this progress ticker.
+            move = asyncio.create_task(controller.move_motor_by_steps('I', 300000, 2000))
+            start = asyncio.get_running_loop().time()
+            while not move.done():
+                print(f"  moving... {asyncio.get_running_loop().time() - start:.0f} s")
+                await asyncio.sleep(1)
+            await move
+            print("Position:", await controller.get_position())
+        finally:
+            print("\nDisabling steppers and closing connection...")
+            await controller.disable_steppers()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,54 @@
+"""Throughput benchmark: stop-and-wait send_gcode vs. windowed stream_gcode.
+
+Runs MotorController against virtual_marlin.VirtualMarlin on a
+pseudo-terminal, so it needs Linux/macOS but no hardware. Motion itself is
+instant by default (--time-scale 0) so only the serial protocol is measured:
+
+    python bench_gcode_streaming.py --count 500 --window 4
+"""
+import argparse
+import time
+
+from motorcontroller import MotorController
+from virtual_marlin import VirtualMarlin
+
+
+def make_moves(count):
+    return [f"G1 I{0.1 if n % 2 else -0.1:.4f} F2000" for n in range(count)]
+
+
+def bench(controller, label, fn, count):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {count:6d} cmds  {elapsed:7.3f} s  {count / elapsed:9.1f} cmd/s")
+    return count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=500)
+    parser.add_argument("--window", type=int, default=4)
+    parser.add_argument("--command-time", type=float, default=0.002, help="firmware time per command (s)")
+    parser.add_argument("--link-delay", type=float, default=0.002, help="serial round-trip delay (s)")
+    parser.add_argument("--time-scale", type=float, default=0.0, help="1 = real motion durations")
+    parser.add_argument("--latency", metavar="JSON", help="record per-command latency and save it here")
+    args = parser.parse_args()
+
+    board = VirtualMarlin(time_scale=args.time_scale, command_time=args.command_time, link_delay=args.link_delay)
+    controller = MotorController(port=board.port, auto_enable=False, window=args.window,
+                                 instrument=args.latency or False)
+    try:
+        moves = make_moves(args.count)
+        baseline = bench(controller, "send_gcode (stop-and-wait)",
+                         lambda: [controller.send_gcode(m) for m in moves], args.count)
+        streamed = bench(controller, f"stream_gcode (window={args.window})",
+                         lambda: controller.stream_gcode(moves), args.count)
+        print(f"speed-up: {streamed / baseline:.2f}x")
+    finally:
+        controller.close()
+        board.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+# Hand-run scripts that drive real hardware as soon as they are imported
+collect_ignore = ["test_xyz(not tested yet).py"]
+# Its modules share names with these (motorcontroller, line_framer): run it on its own,
+# cd Automated_v1 && python -m pytest -q
+collect_ignore.append("Automated_v1")
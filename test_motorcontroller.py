@@ -0,0 +1,146 @@
+"""Regression tests: MotorController against the virtual board (virtual_marlin).
+
+Covers the streaming window, Resend recovery in reliable mode, the
+emergency lane with latency instrumentation on, waiting for motion after a
+stop, and MotionHandle polling. Needs Linux/macOS for the pseudo-terminal:
+
+    python -m pytest -q test_motorcontroller.py
+
+The Automated_v1 station (its controller, flow, gravimetric dispensing) has
+its own tests: cd Automated_v1 && python -m pytest -q
+"""
+import random
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("pty")
+
+from motorcontroller import CommandAborted, MotorController  # noqa: E402
+from virtual_marlin import VirtualMarlin  # noqa: E402
+
+TIMEOUT = 30.0  # s any one test may take before it counts as hung
+
+
+def _within(fn, timeout=TIMEOUT):
+    """Run `fn` on a daemon thread and return its result; fail if it hangs."""
+    result = {}
+
+    def run():
+        try:
+            result['value'] = fn()
+        except BaseException as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        pytest.fail(f"hung for {timeout:g} s")
+    if 'error' in result:
+        raise result['error']
+    return result.get('value')
+
+
+def _targets(board):
+    """Axis word of every G1 the board executed, in order (F is elided when unchanged)."""
+    return [c.split()[1] for c in board.commands if c.startswith("G1")]
+
+
+@pytest.fixture
+def board():
+    boards = []
+
+    def make(**options):
+        boards.append(VirtualMarlin(**options))
+        return boards[-1]
+
+    yield make
+    for b in boards:
+        b.close()
+
+
+def test_stream_keeps_window_in_flight(board):
+    b = board(time_scale=0, link_delay=0.002)
+    mc = MotorController(port=b.port, auto_enable=False, window=4)
+    in_flight = []
+    mc.subscribe('sent', lambda cmd: in_flight.append(len(mc._inflight)))
+    moves = [f"G1 I{n} F2000" for n in range(100)]
+    try:
+        responses = _within(lambda: mc.stream_gcode(moves))
+    finally:
+        mc.close()
+    assert len(responses) == len(moves)
+    assert _targets(b) == [f"I{n}" for n in range(100)]
+    assert 1 < max(in_flight) <= 4
+
+
+def test_resend_recovers_corrupted_lines(board):
+    random.seed(1)
+    b = board(time_scale=0, corrupt_rate=0.1)
+    mc = MotorController(port=b.port, auto_enable=False, reliable=True)
+    moves = [f"G1 I{n} F2000" for n in range(100)]
+    try:
+        _within(lambda: mc.stream_gcode(moves))
+    finally:
+        mc.close()
+    assert mc.resend_count > 0
+    assert _targets(b) == [f"I{n}" for n in range(100)]
+    assert not mc._inflight
+
+
+def test_emergency_stop_with_instrumentation(board):
+    b = board(time_scale=1)
+    mc = MotorController(port=b.port, instrument=True)
+    try:
+        mc.set_relative_positioning()
+        move = mc.move_motor_by_steps('X', 8000, 1200)  # 100 mm, several seconds
+        time.sleep(0.3)
+        _within(lambda: mc.emergency("M410"))
+        assert mc._dispatcher.is_alive()
+        with pytest.raises(CommandAborted):
+            move.wait()
+        stopped = mc.planned_position('X')
+        assert 0 < stopped < 100
+        assert _within(lambda: mc.send_gcode("M114"))[-1] == "ok"
+        assert mc.latency.verbs['M410']['ok'].count == 1
+    finally:
+        mc.close()
+
+
+def test_wait_for_motion_after_emergency_stop(board):
+    b = board(time_scale=1)
+    mc = MotorController(port=b.port)
+    try:
+        mc.set_relative_positioning()
+        cut = mc.move_motor_by_steps('X', 8000, 1200)
+        time.sleep(0.3)
+        _within(lambda: mc.emergency("M410"))
+        # Only a wait on the move that was cut short reports the stop...
+        with pytest.raises(CommandAborted):
+            cut.wait(timeout=5)
+        # ...waiting for the board to be idle, or for later moves, does not
+        _within(lambda: mc.wait_for_motion(timeout=5))
+        after = mc.move_motor_by_steps('X', -80, 1200)
+        _within(lambda: after.wait(timeout=5))
+        _within(lambda: mc.wait_for_motion(timeout=5))
+        assert _targets(b)[-1] == "X-1.0000"
+    finally:
+        mc.close()
+
+
+def test_motion_handle_done_without_waiting(board):
+    b = board(time_scale=1)
+    mc = MotorController(port=b.port)
+    try:
+        mc.set_relative_positioning()
+        move = mc.move_motor_by_steps('X', 400, 1200)  # 5 mm, about 0.3 s
+
+        def poll():
+            while not move.done():
+                time.sleep(0.01)
+        _within(poll, timeout=5)
+        assert mc.axis_stopped['X'].is_set()
+    finally:
+        mc.close()
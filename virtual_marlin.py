@@ -0,0 +1,466 @@
+"""Virtual Octopus/Marlin board on a pseudo-terminal.
+
+Speaks enough of Marlin's serial protocol for MotorController to run
+unchanged against it: pass `board.port` as the port. Moves take the time
+the firmware's feedrate and acceleration limits give them, 'ok' follows
+Marlin's rules (after a move is planned, after M400 once motion stops),
+and 'busy:' keepalives, 'echo:' lines, N/checksum framing, Resend and the
+emergency parser (M108/M410/M112) are emulated. Needs Linux/macOS (pty).
+
+    with VirtualMarlin() as board:
+        mc = MotorController(port=board.port)
+
+Or run it standalone and connect from another process:
+
+    python virtual_marlin.py
+"""
+import math
+import os
+import pty
+import queue
+import random
+import re
+import select
+import threading
+import time
+import tty
+
+from motorcontroller import (DEFAULT_ACCELERATION, DEFAULT_FEEDRATE, DEFAULT_RETRACT_ACCELERATION,
+                             MAX_ACCELERATION, MAX_FEEDRATE, feed_reference_distance, trapezoid_time)
+
+AXES = ('X', 'Y', 'Z', 'I', 'J', 'K', 'U', 'V', 'W', 'E')
+
+# From Marlin/Configuration.h of the 10-axis Octopus MAX EZ build; the motion
+# limits are shared with MotorController's move time model
+STEPS_PER_UNIT = {'X': 80, 'Y': 80, 'Z': 80, 'I': 80, 'J': 80, 'K': 80, 'U': 80, 'V': 80, 'W': 80, 'E': 500}
+HOMING_FEEDRATE = {'X': 50, 'Y': 50, 'Z': 4, 'I': 50, 'J': 50, 'K': 50, 'U': 50, 'V': 50, 'W': 50}  # mm/s
+BUFSIZE = 4
+BLOCK_BUFFER_SIZE = 16
+QUICKSTOP_HOLD = 1.0  # s the planner refuses new moves after M410 (Planner::quick_stop)
+
+_WORD = re.compile(r"([A-Z])\s*(-?\d*\.?\d*)")
+
+
+def trapezoid_distance(t, distance, speed, accel):
+    """Distance covered after `t` seconds of a trapezoid move of `distance`."""
+    if distance <= 0:
+        return 0.0
+    total = trapezoid_time(distance, speed, accel)
+    if t >= total:
+        return distance
+    peak = min(speed, math.sqrt(distance * accel))
+    ramp = peak / accel
+    if t <= ramp:
+        return 0.5 * accel * t * t
+    ramp_dist = 0.5 * peak * ramp
+    if t <= total - ramp:
+        return ramp_dist + peak * (t - ramp)
+    left = total - t
+    return distance - 0.5 * accel * left * left
+
+
+class _Block:
+    """One planned move: start/end positions and timing on the board clock."""
+
+    def __init__(self, start_pos, delta, start, duration, length, speed, accel):
+        self.start_pos = start_pos
+        self.delta = delta
+        self.start = start
+        self.end = start + duration
+        self.length = length
+        self.speed = speed
+        self.accel = accel
+
+    def position_at(self, t):
+        if t >= self.end or self.length <= 0:
+            fraction = 1.0
+        else:
+            fraction = trapezoid_distance(t - self.start, self.length, self.speed, self.accel) / self.length
+        return {axis: self.start_pos[axis] + self.delta.get(axis, 0.0) * fraction for axis in AXES}
+
+
+class VirtualMarlin:
+    """Emulated Marlin endpoint. Options:
+    - extruders: number of tools T0..T<n-1> (1 for the 10-axis build, 5 for Automated_v1).
+    - time_scale: multiply every motion duration (0 makes motion instant).
+    - command_time: firmware time spent parsing each command (s).
+    - link_delay: delay before a received line reaches the parser (s).
+    - corrupt_rate: probability that a numbered line is received corrupted.
+    - advanced_ok: answer 'ok P<planner free> B<queue free>'.
+    - keepalive: seconds between 'busy: processing' messages (0 disables).
+    - emergency_parser: act on M108/M410/M112 as they arrive (EMERGENCY_PARSER).
+    """
+
+    def __init__(self, extruders=1, time_scale=1.0, command_time=0.0, link_delay=0.0,
+                 corrupt_rate=0.0, advanced_ok=False, keepalive=2.0, emergency_parser=True):
+        self.extruders = extruders
+        self.time_scale = time_scale
+        self.command_time = command_time
+        self.link_delay = link_delay
+        self.corrupt_rate = corrupt_rate
+        self.advanced_ok = advanced_ok
+        self.keepalive = keepalive
+        self.emergency_parser = emergency_parser
+
+        self.position = {axis: 0.0 for axis in AXES}  # planner (commanded) position
+        self.relative = False
+        self.tool = 0
+        self.feedrate = DEFAULT_FEEDRATE / 60.0  # mm/s
+        self.steppers_enabled = False
+        self.soft_endstops = True
+        self.last_n = 0
+        self.report_interval = 0  # M154 position auto-report period (s), 0 = off
+        self.commands = []  # every command executed, for inspection in tests
+        self.halted = False  # killed by M112
+        self.stop_times = []  # monotonic time of every quickstop, for reaction tests
+
+        self._blocks = []
+        self._motion_lock = threading.Lock()
+        self._stops = 0
+        self._hold_until = 0.0
+        self._rx_queue = queue.Queue(maxsize=BUFSIZE)
+        self._write_lock = threading.Lock()
+        self._running = True
+
+        self.master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._reader = threading.Thread(target=self._reader_loop, name="virtual-marlin-rx", daemon=True)
+        self._executor = threading.Thread(target=self._executor_loop, name="virtual-marlin", daemon=True)
+        self._reporter = threading.Thread(target=self._report_loop, name="virtual-marlin-report", daemon=True)
+        self._reader.start()
+        self._executor.start()
+        self._reporter.start()
+        self._send("start")
+        self._send("echo:Marlin 2.1.2.5 (virtual)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._running = False
+        self._reader.join(timeout=1)
+        self._executor.join(timeout=1)
+        self._reporter.join(timeout=1)
+        os.close(self.master)
+        os.close(self._slave)
+
+    # —— Serial side —— #
+
+    def _send(self, line):
+        with self._write_lock:
+            os.write(self.master, (line + "\n").encode())
+
+    def _ok(self):
+        if self.advanced_ok:
+            self._send(f"ok P{BLOCK_BUFFER_SIZE - len(self._pending_blocks())} "
+                       f"B{BUFSIZE - self._rx_queue.qsize()}")
+        else:
+            self._send("ok")
+
+    def _reader_loop(self):
+        """Split the byte stream into lines; the bounded queue is the firmware's BUFSIZE."""
+        rx = b""
+        while self._running:
+            ready, _, _ = select.select([self.master], [], [], 0.05)
+            if not ready:
+                continue
+            try:
+                rx += os.read(self.master, 4096)
+            except OSError:
+                break
+            while b"\n" in rx:
+                raw, rx = rx.split(b"\n", 1)
+                line = raw.decode(errors="ignore").strip()
+                if line and self.emergency_parser:
+                    self._parse_emergency(line)
+                if line and not self.halted:
+                    # Blocks while the command queue is full, like the real board
+                    # stops draining its RX buffer
+                    while self._running:
+                        try:
+                            self._rx_queue.put((time.monotonic(), line), timeout=0.1)
+                            break
+                        except queue.Full:
+                            continue
+
+    def _parse_emergency(self, line):
+        """EMERGENCY_PARSER: act on M108/M410/M112 the moment they are received.
+        The line still goes through the queue afterwards (as a no-op with an 'ok')."""
+        words = line.split("*")[0].split()
+        if words and words[0].startswith("N"):
+            words = words[1:]
+        head = words[0].upper() if words else ""
+        if head == "M410":
+            self._quick_stop()
+        elif head == "M112":
+            self._kill()
+
+    def _quick_stop(self):
+        """Drop every planned block where the motors are now (M410)."""
+        with self._motion_lock:
+            now = time.monotonic()
+            self.position = self.realtime_position()
+            self._blocks = []
+            self._stops += 1
+            self._hold_until = now + QUICKSTOP_HOLD * self.time_scale
+            self.stop_times.append(now)
+
+    def _kill(self):
+        self._quick_stop()
+        self.halted = True
+        while True:
+            try:
+                self._rx_queue.get_nowait()
+            except queue.Empty:
+                break
+        self._send("Error:Printer halted. kill() called!")
+
+    def _executor_loop(self):
+        while self._running:
+            try:
+                received, line = self._rx_queue.get(timeout=0.05)
+            except queue.Empty:
+                continue
+            if self.halted:
+                continue
+            # After a quickstop nothing is processed until the planner takes moves again
+            self._wait_hold()
+            delay = received + self.link_delay + self.command_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            line = self._check_framing(line)
+            if line is None:
+                continue
+            self.commands.append(line)
+            self._execute(line)
+
+    def _check_framing(self, line):
+        """Validate 'N<n> ...*<cs>' lines; returns the bare command or None if rejected."""
+        if not line.startswith("N"):
+            return line
+        if self.corrupt_rate and random.random() < self.corrupt_rate:
+            line = line[:-1] + ("0" if line[-1] != "0" else "1")
+        body, star, checksum = line.rpartition("*")
+        if not star:
+            body = line
+        head, _, cmd = body.partition(" ")
+        try:
+            n = int(head[1:])
+        except ValueError:
+            n = -1
+        if cmd.upper().startswith("M110"):
+            match = re.search(r"N(-?\d+)", cmd[4:])
+            n = int(match.group(1)) if match else n
+        elif n != self.last_n + 1:
+            if self.last_n - 1 <= n <= self.last_n:
+                return None  # a line already in transit when we asked for a resend
+            return self._line_error("Line Number is not Last Line Number+1, Last Line: ")
+        if not star:
+            return self._line_error("No Checksum with line number, Last Line: ")
+        calc = 0
+        for byte in body.encode():
+            calc ^= byte
+        if not checksum.isdigit() or int(checksum) != calc:
+            return self._line_error("checksum mismatch, Last Line: ")
+        self.last_n = n
+        return cmd
+
+    def _line_error(self, message):
+        self._send(f"Error:{message}{self.last_n}")
+        # Marlin throws away whatever else is waiting in its buffer
+        while True:
+            try:
+                self._rx_queue.get_nowait()
+            except queue.Empty:
+                break
+        self._send(f"Resend: {self.last_n + 1}")
+        self._send("ok")
+        return None
+
+    def _report_loop(self):
+        """AUTO_REPORT_POSITION: report the planner position every M154 S seconds."""
+        next_report = None
+        while self._running:
+            time.sleep(0.02)
+            if not self.report_interval:
+                next_report = None
+                continue
+            now = time.monotonic()
+            if next_report is None:
+                next_report = now + self.report_interval
+            elif now >= next_report:
+                self._report_position()
+                next_report += self.report_interval
+
+    def _report_position(self):
+        # Like Marlin's M114/M154: the position of the last planned move, not the
+        # one the motors have reached
+        pos = " ".join(f"{axis}:{self.position[axis]:.2f}" for axis in AXES)
+        counts = " ".join(f"{axis}:{round(self.position[axis] * STEPS_PER_UNIT[axis])}" for axis in AXES)
+        self._send(f"{pos} Count {counts}")
+
+    # —— Motion —— #
+
+    def _pending_blocks(self):
+        now = time.monotonic()
+        self._blocks = [b for b in self._blocks if b.end > now]
+        return self._blocks
+
+    def realtime_position(self):
+        """Where the motors actually are right now (the planner position is ahead)."""
+        now = time.monotonic()
+        for block in self._pending_blocks():
+            if block.start <= now:
+                return block.position_at(now)
+        if self._blocks:
+            return dict(self._blocks[0].start_pos)
+        return dict(self.position)
+
+    def _wait_until(self, t):
+        """Sleep until board time `t`, sending busy keepalives like HOST_KEEPALIVE_FEATURE.
+        A quickstop ends the wait early."""
+        next_busy = time.monotonic() + self.keepalive if self.keepalive else None
+        stops = self._stops
+        while self._running:
+            now = time.monotonic()
+            if now >= t or self._stops != stops:
+                return
+            if next_busy is not None and now >= next_busy:
+                self._send("echo:busy: processing")
+                next_busy += self.keepalive
+            wake = t if next_busy is None else min(t, next_busy)
+            time.sleep(min(0.05, max(0.0, wake - now)))
+
+    def _wait_hold(self):
+        """Wait out the planner hold after a quickstop."""
+        while self._running and time.monotonic() < self._hold_until:
+            self._wait_until(self._hold_until)
+
+    def _synchronize(self):
+        if self._blocks:
+            self._wait_until(self._blocks[-1].end)
+        self._wait_hold()
+        self._pending_blocks()
+
+    def _plan(self, target, feedrate):
+        # Wait for a free planner slot (and out a quickstop's hold)
+        while len(self._pending_blocks()) >= BLOCK_BUFFER_SIZE and self._running:
+            self._wait_until(self._blocks[0].end)
+        self._wait_hold()
+        with self._motion_lock:
+            self._plan_block(target, feedrate)
+
+    def _plan_block(self, target, feedrate):
+        delta = {axis: target[axis] - self.position[axis] for axis in AXES if target[axis] != self.position[axis]}
+        if not delta:
+            return
+        length = feed_reference_distance(delta)
+        speed = feedrate
+        accel = DEFAULT_RETRACT_ACCELERATION if set(delta) == {'E'} else DEFAULT_ACCELERATION
+        for axis, d in delta.items():
+            share = abs(d) / length
+            if share > 0:
+                speed = min(speed, MAX_FEEDRATE[axis] / share)
+                accel = min(accel, MAX_ACCELERATION[axis] / share)
+        duration = trapezoid_time(length, speed, accel) * self.time_scale
+        # Queue behind the last block
+        start = max(time.monotonic(), self._blocks[-1].end if self._blocks else 0.0)
+        self._blocks.append(_Block(dict(self.position), delta, start, duration, length, speed, accel))
+        self.position = target
+
+    # —— G-code —— #
+
+    def _execute(self, line):
+        words = dict((letter, value) for letter, value in _WORD.findall(line.upper().split(";")[0]))
+        head = line.split()[0].upper()
+        if head in ("G0", "G1"):
+            if 'F' in words and words['F']:
+                self.feedrate = float(words['F']) / 60.0
+            target = dict(self.position)
+            for axis in AXES:
+                if axis in words and words[axis] not in ("", "-"):
+                    value = float(words[axis])
+                    target[axis] = target[axis] + value if self.relative else value
+            self._plan(target, self.feedrate)
+        elif head == "G28":
+            self._synchronize()
+            axes = [axis for axis in HOMING_FEEDRATE if axis in line.upper().split()[1:]] or list(HOMING_FEEDRATE)
+            duration = max(abs(self.position[axis]) / HOMING_FEEDRATE[axis] for axis in axes)
+            self._wait_until(time.monotonic() + duration * self.time_scale)
+            for axis in axes:
+                self.position[axis] = 0.0
+        elif head == "G90":
+            self.relative = False
+        elif head == "G91":
+            self.relative = True
+        elif head == "G92":
+            self._synchronize()
+            for axis in AXES:
+                if axis in words and words[axis] not in ("", "-"):
+                    self.position[axis] = float(words[axis])
+        elif head == "M17":
+            self.steppers_enabled = True
+        elif head in ("M18", "M84"):
+            self._synchronize()
+            self.steppers_enabled = False
+        elif head == "M110":
+            pass  # line number already taken in _check_framing
+        elif head == "M114":
+            self._report_position()
+        elif head == "M113":
+            if 'S' in words and words['S']:
+                self.keepalive = float(words['S'])
+            self._send(f"echo:M113 S{self.keepalive:g}")
+        elif head == "M115":
+            self._send("FIRMWARE_NAME:Marlin 2.1.2.5 (virtual) SOURCE_CODE_URL:github.com/MarlinFirmware/Marlin "
+                       f"PROTOCOL_VERSION:1.0 MACHINE_TYPE:Octopus EXTRUDER_COUNT:{self.extruders} AXIS_COUNT:{len(AXES) - 1}")
+            for cap in ("SERIAL_XON_XOFF:0", "EEPROM:1", "AUTOREPORT_POS:1", "HOST_ACTION_COMMANDS:0",
+                        f"EMERGENCY_PARSER:{int(self.emergency_parser)}"):
+                self._send(f"Cap:{cap}")
+        elif head == "M154":
+            if 'S' in words and words['S']:
+                self.report_interval = float(words['S'])
+        elif head == "M400":
+            self._synchronize()
+        elif head in ("M108", "M410", "M112"):
+            if not self.emergency_parser:
+                # Only reached in queue order, after everything sent before it
+                if head == "M410":
+                    self._quick_stop()
+                    self._synchronize()
+                elif head == "M112":
+                    self._kill()
+                    return
+        elif head == "M211":
+            if 'S' in words and words['S']:
+                self.soft_endstops = bool(int(float(words['S'])))
+            self._send(f"echo:Soft endstops: {'On ' if self.soft_endstops else 'Off'}")
+        elif head.startswith("T") and head[1:].isdigit():
+            index = int(head[1:])
+            if index >= self.extruders:
+                self._send(f"echo:T{index} Invalid extruder")
+            else:
+                self._synchronize()
+                self.tool = index
+        else:
+            self._send(f'echo:Unknown command: "{line}"')
+        self._ok()
+
+
+def main():
+    with VirtualMarlin() as board:
+        print(f"Virtual Marlin on {board.port}  (MotorController(port='{board.port}'))")
+        print("Press Ctrl-C to exit.")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print("\nExiting...")
+
+
+if __name__ == "__main__":
+    main()
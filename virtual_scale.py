@@ -0,0 +1,176 @@
+"""Virtual balance on a pseudo-terminal.
+
+Stands in for the scale on COM5 so the scale reader, the stream and the
+closed-loop dispensing can run without hardware: pass `scale.port` as the
+scale port. Like the real balance it either sends a reading continuously or
+answers requests (SI / S: one reading, ENQ: one reading), with the time a
+9600 baud line needs for every byte. Unknown commands get MT-SICS' 'ES'.
+
+The mass can follow a VirtualMarlin: every axis listed in `g_per_mm` adds
+its distance from zero times that many grams, seen through a first-order
+lag like liquid reaching the pan, plus Gaussian noise.
+
+    with VirtualMarlin(extruders=5) as board, VirtualScale(board, {'X': 0.05}) as scale:
+        motor = MotorController(port=board.port)
+        w = connections.scale_stream(scale.port).wait_stable()
+
+Or run it standalone and connect from another process:
+
+    python virtual_scale.py [request]
+"""
+import os
+import pty
+import queue
+import random
+import select
+import threading
+import time
+import tty
+
+ENQ = 0x05
+
+
+class VirtualScale:
+    """Emulated balance. Options:
+    - board: object with realtime_position() (a VirtualMarlin) the mass follows.
+    - g_per_mm: {axis: grams per mm of that axis' distance from zero}.
+    - mode: 'continuous' (send `rate` readings/s) or 'request' (only answer
+      SI/S/ENQ, which a continuous balance answers too).
+    - rate: continuous output rate, and the balance's own measurement rate.
+    - response_time: s from a request to the start of its reply.
+    - baud: line speed; every byte sent takes 10 bits of it (0: instant).
+    - noise: standard deviation of a reading (g); lag: time constant (s); base: tare (g).
+    """
+
+    def __init__(self, board=None, g_per_mm=None, mode='continuous', rate=10.0, response_time=0.01,
+                 baud=9600, noise=0.0005, lag=0.5, base=20.0):
+        self.board = board
+        self.g_per_mm = dict(g_per_mm or {})
+        self.mode = mode
+        self.rate = rate
+        self.response_time = response_time
+        self.baud = baud
+        self.noise = noise
+        self.lag = lag
+        self.base = base
+        self.extra = 0.0    # grams added by hand (tests), on top of the board's
+        self.requests = 0   # requests received
+        self.sent = 0       # readings sent
+
+        self._shown = None
+        self._shown_at = time.monotonic()
+        self._mass_lock = threading.Lock()
+        self._tx_queue = queue.Queue()
+        self._running = True
+
+        self.master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._threads = [threading.Thread(target=target, name=f"virtual-scale-{name}", daemon=True)
+                         for name, target in (("rx", self._rx_loop), ("tx", self._tx_loop),
+                                              ("continuous", self._continuous_loop))]
+        for thread in self._threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._running = False
+        self._tx_queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout=1)
+        os.close(self.master)
+        os.close(self._slave)
+
+    def true_mass(self):
+        """Mass on the pan right now, without lag or noise."""
+        mass = self.base + self.extra
+        if self.board is not None and self.g_per_mm:
+            position = self.board.realtime_position()
+            for axis, grams in self.g_per_mm.items():
+                mass += abs(position[axis]) * grams
+        return mass
+
+    def reading(self):
+        """What the balance shows now: the lagged mass plus noise."""
+        with self._mass_lock:
+            now = time.monotonic()
+            target = self.true_mass()
+            if self._shown is None:
+                self._shown = target
+            elif self.lag:
+                self._shown += (target - self._shown) * min(1.0, (now - self._shown_at) / self.lag)
+            else:
+                self._shown = target
+            self._shown_at = now
+            return self._shown + random.gauss(0.0, self.noise)
+
+    def _frame(self, prefix):
+        return f"{prefix} {self.reading():10.4f} g\r\n".encode()
+
+    def _tx_loop(self):
+        while self._running:
+            data = self._tx_queue.get()
+            if data is None:
+                return
+            if self.baud:
+                time.sleep(len(data) * 10 / self.baud)
+            try:
+                os.write(self.master, data)
+            except OSError:
+                return
+            self.sent += 1
+
+    def _continuous_loop(self):
+        while self._running:
+            time.sleep(1.0 / self.rate)
+            # A real balance drops readings while the line is still busy
+            if self.mode == 'continuous' and self._tx_queue.empty():
+                self._tx_queue.put(self._frame("ST,GS,"))
+
+    def _rx_loop(self):
+        buf = b""
+        while self._running:
+            ready, _, _ = select.select([self.master], [], [], 0.05)
+            if not ready:
+                continue
+            try:
+                buf += os.read(self.master, 4096)
+            except OSError:
+                return
+            while ENQ in buf:
+                buf = buf.replace(bytes([ENQ]), b"", 1)
+                self._answer()
+            while b"\n" in buf:
+                line, buf = buf.split(b"\n", 1)
+                command = line.strip().upper()
+                if command in (b"SI", b"S"):
+                    self._answer()
+                elif command:
+                    self._tx_queue.put(b"ES\r\n")
+
+    def _answer(self):
+        self.requests += 1
+        time.sleep(self.response_time)
+        self._tx_queue.put(self._frame("S S"))
+
+
+def main():
+    import sys
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'continuous'
+    with VirtualScale(mode=mode) as scale:
+        print(f"Virtual scale ({mode}) on {scale.port}  (open_scale(port='{scale.port}'))")
+        print("Press Ctrl-C to exit.")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print("\nExiting...")
+
+
+if __name__ == "__main__":
+    main()